@@ -1,22 +1,67 @@
 #!/usr/bin/env python
 # Add missing image quality measures using PyImageQualityRanking to DB entries.
+# Measures are computed in a process pool, independent of the apply worker, and can run as a daemon.
 
 import os
+import socket
+import traceback
+from multiprocessing import Pool, cpu_count
 
 import db
-from config import config
+from config import config, add_config_option
 from image_measures import get_image_measures
 
 
-def add_image_measures():
-    for s in db.samples.find({'processed': True}):
-        if not s.get('imq_entropy'):
-            image_filename = s['filename']
-            print 'Processing %s...' % image_filename
-            image_filename_full = os.path.join(config.get_server_image_path(), image_filename)
-            image_measures = get_image_measures(image_filename_full)
-            db.set_image_measures(s['_id'], image_measures)
+# Identifies this worker process in sample claims
+worker_id = 'imq-%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def compute_image_measures(image_filename):
+    # Runs in pool processes (no DB access). Returns measures and error string.
+    try:
+        return get_image_measures(os.path.join(config.get_server_image_path(), image_filename)), None
+    except:
+        return {}, traceback.format_exc()
+
+
+def add_image_measures(pool, batch_size):
+    # Compute measures for all samples that are missing them. Returns number of processed samples.
+    n = 0
+    while True:
+        sample_batch = db.claim_samples_without_image_measures(worker_id, batch_size)
+        if not sample_batch:
+            return n
+        results = pool.map(compute_image_measures, [s['filename'] for s in sample_batch])
+        for s, (image_measures, error_string) in zip(sample_batch, results):
+            print 'Image measures for %s%s' % (s['filename'], ' failed.' if error_string else '.')
+            db.set_image_measures(s['_id'], image_measures, error_string=error_string)
+        n += len(sample_batch)
+
+
+def run_daemon(pool, batch_size):
+    listener = db.EventListener([db.event_samples])
+    while True:
+        db.set_status('imq_worker', 'Processing...')
+        add_image_measures(pool, batch_size)
+        db.set_status('imq_worker', 'Waiting for images...')
+        listener.wait(db.event_poll_seconds)
 
 
 if __name__ == '__main__':
-    add_image_measures()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compute missing image quality measures of samples.')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and process new images as they arrive.')
+    add_config_option(parser)
+    args = parser.parse_args()
+    processes = config.image_measure_processes or cpu_count()
+    measure_pool = Pool(processes)
+    try:
+        if args.daemon:
+            run_daemon(measure_pool, processes * 2)
+        else:
+            print 'Processed %d samples.' % add_image_measures(measure_pool, processes * 2)
+    finally:
+        measure_pool.terminate()
+        if args.daemon:
+            db.set_status('imq_worker', 'offline')
@@ -2,12 +2,16 @@
 # Apply trained FCN to input file(s)
 
 import os
+import threading
+import traceback
+from collections import OrderedDict
 
 from config import config
 from apply_fcn_caffe import init_model
+import db
 
 
-def load_model(iter, model_name, train_name, fc8_suffix, input_size, model_id):
+def load_model(iter, model_name, train_name, fc8_suffix, input_size, model_id, margin=None, stride=None):
     basename = train_name + '_iter_' + str(iter) + '_fcn.caffemodel'
     #model_fn = os.path.join(config.src_path, 'cnn', 'out', train_name + '_iter_' + str(iter) + '_fcn.caffemodel')
     model_fn = os.path.join(config.get_cnn_path(), str(model_id), 'out', basename)
@@ -18,7 +22,12 @@ def load_model(iter, model_name, train_name, fc8_suffix, input_size, model_id):
                      worker_gpu_index=config.worker_gpu_index,
                      net_output_name='fc8' + fc8_suffix + '-conv',
                      input_size=input_size,
-                     network_name=network_name)
+                     network_name=network_name,
+                     fold_input_mean=True,  # alexnetfcn does not pad conv1
+                     backend=config.worker_backend,
+                     threads=config.worker_threads,
+                     margin=margin,
+                     stride=stride)
     return net
 
 
@@ -28,4 +37,80 @@ def load_model_by_record(model):
     train_name = 'alexnetftc'
     fc8_suffix = 'stoma'
     input_size = (2048, 2048)
-    return load_model(iter, model_name, train_name, fc8_suffix, input_size, model_id=model['_id'])
+    net = load_model(iter, model_name, train_name, fc8_suffix, input_size, model_id=model['_id'],
+                     margin=model.get('net_margin'), stride=model.get('net_stride'))
+    if model.get('net_margin') is None or model.get('net_stride') is None:
+        # Store network geometry, so the probe does not have to be repeated on the next load
+        db.set_model_parameters(model['_id'], {'net_margin': net.margin, 'net_stride': net.stride})
+    return net
+
+
+class NetCache:
+    # Loaded networks kept resident by model ID (least recently used first), bounded by their total memory: Weights
+    # and the activation blobs sized for the largest input each net has processed
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nets = OrderedDict()
+
+    def get(self, model):
+        net = self.nets.pop(model['_id'], None)
+        if net is None:
+            net = load_model_by_record(model)
+            net.weights_bytes = os.path.getsize(net.weights_filename)
+        self.nets[model['_id']] = net
+        # Keep at least the requested net even if it exceeds the budget by itself
+        while len(self.nets) > 1 and sum(n.weights_bytes + n.peak_blobs_bytes
+                                         for n in self.nets.itervalues()) > self.max_bytes:
+            evicted_model_id, _ = self.nets.popitem(last=False)
+            print 'Unloaded net of model %s' % str(evicted_model_id)
+        return net
+
+
+class PrimaryModelLoader:
+    # Watches for changes of the primary model and loads the new network in a background thread, so the worker can
+    # keep processing with the current network until it switches over (see swap).
+
+    def __init__(self, model):
+        self.model = model
+        self.loading_model_id = None
+        self.next_model_net = None
+        self.ready = threading.Event()
+
+    def start_watching(self):
+        watch_thread = threading.Thread(target=self.watch_forever)
+        watch_thread.daemon = True
+        watch_thread.start()
+
+    def watch_forever(self):
+        listener = db.EventListener([db.event_models])
+        while True:
+            try:
+                self.check()
+            except:
+                traceback.print_exc()
+            listener.wait(db.event_poll_seconds)
+
+    def check(self):
+        if self.loading_model_id is not None or self.ready.is_set():
+            return
+        model = db.get_primary_model()
+        if model is None or model['_id'] == self.model['_id']:
+            return
+        self.loading_model_id = model['_id']
+        try:
+            print 'Loading new primary model %s...' % model['name']
+            self.next_model_net = (model, load_model_by_record(model))
+            self.ready.set()
+            # Wake up the worker if it is idle
+            db.notify_event(db.event_models)
+        finally:
+            self.loading_model_id = None
+
+    def swap(self):
+        # Returns the new (model, net) once ready is set
+        model, net = self.next_model_net
+        self.next_model_net = None
+        self.model = model
+        self.ready.clear()
+        return model, net
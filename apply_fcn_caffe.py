@@ -1,16 +1,34 @@
 #!/usr/bin/env python
 # Apply trained FCN to input file(s)
 
-import caffe
 import matplotlib.pyplot as plt
 import matplotlib.colors as plc
 import numpy as np
-from scipy.ndimage import zoom
 import cv2
 
+from image_loader import load_image, get_image_size
+from image_pyramid import get_image_level, resize_image
+from cnn_backend import load_backend
 
+
+# Images larger than this (in either dimension) are processed in overlapping tiles of this size
 max_image_size = 4096
 
+# Input shapes can be padded up to multiples of this size, so similar image sizes share blob shapes.
+# Must be a multiple of the network stride. This is an approximation: The padding is only zero at the input, so the
+# outputs next to the right and bottom border differ from those of the unpadded image. Off (None) by default, so
+# every image is processed at its exact size.
+input_bucket_size = None
+
+# Input size of the probe forward passes that determine network margin and stride
+net_probe_size = 512
+
+# Size of the (zoomed) center crop used to pick the best of multiple candidate scales
+scale_probe_size = 768
+
+# Per-channel dataset mean (BGR)
+image_mean = np.array((104, 117, 123), dtype=np.float32)
+
 
 def fc8_to_prob(v):
     return np.exp(v) / (np.exp(v) + np.exp(-v))
@@ -21,121 +39,276 @@ def prob_to_fc8(p):
     return np.log(p/(1-p)) / 2
 
 
-def init_model(model_fn, proto_fn_fcn, worker_gpu_index, net_output_name, input_size, network_name):
-    if worker_gpu_index > 0:
-        caffe.set_mode_gpu()
-        caffe.set_device(worker_gpu_index)
-    else:
-        caffe.set_mode_cpu()
-    net = caffe.Net(proto_fn_fcn, caffe.TEST, weights=model_fn)
-    net.original_shape = list(net.blobs['data'].shape)
-    net.blobs['data'].reshape(1, 3, input_size[1], input_size[0])
-    net.input_size = input_size[:2]
-    init_model_transformer(net)
+def init_model(model_fn, proto_fn_fcn, worker_gpu_index, net_output_name, input_size, network_name,
+               bucket_size=input_bucket_size, fold_input_mean=False, backend='caffe', threads=0, margin=None,
+               stride=None):
+    net = load_backend(backend, proto_fn_fcn, model_fn, gpu_index=worker_gpu_index, threads=threads)
+    net.original_shape = list(net.get_input_shape())
+    net.weights_filename = model_fn
+    net.input_size = tuple(input_size[:2])
+    net.bucket_size = bucket_size
+    net.input_offset = image_mean.reshape((3, 1, 1))
+    if fold_input_mean:
+        fold_input_mean_into_weights(net)
     net.output_name = net_output_name
     net.name = network_name
-    net.stride = 32
-    net.margin = get_net_margin(net)
-    print 'Loaded net %s (margin %d)' % (net.name, net.margin)
+    if margin is None or stride is None:
+        # Not known from a previous load: Determine by tiny forward passes
+        net.margin, net.stride = get_net_margin_and_stride(net)
+    else:
+        net.margin, net.stride = margin, stride
+    net.output_size_offsets = {}
+    # Activation memory of the largest input processed so far (blobs are not shrunk for smaller inputs)
+    net.peak_input_size = 0
+    net.peak_blobs_bytes = 0
+    init_model_input(net)
+    print 'Loaded net %s (margin %d, backend %s)' % (net.name, net.margin, net.backend_name)
     return net
 
 
-def init_model_transformer(net):
-    net.blobs['data'].reshape(1, 3, net.input_size[1], net.input_size[0])
-    # create transformer for the input called 'data'
-    transformer = caffe.io.Transformer({'data': (1, 3, net.input_size[1], net.input_size[0])})
-    transformer.set_transpose('data', (2, 0, 1))  # move image channels to outermost dimension
-    transformer.set_mean('data', np.array((104, 117, 123)))  # subtract the dataset-mean value in each channel
-    transformer.set_raw_scale('data', 255)  # rescale from [0, 1] to [0, 255]
-    transformer.set_channel_swap('data', (2, 1, 0))  # swap channels from RGB to BGR
-    net.transformer = transformer
-    return transformer
+def init_model_input(net):
+    net.reshape_input((1, 3, net.input_size[1], net.input_size[0]))
+
+
+def fold_input_mean_into_weights(net):
+    # Subtract the constant mean contribution from the bias of the first convolution, so raw BGR values can be fed
+    # directly: conv(x - mean) = conv(x) - conv(mean). Only valid if the first convolution does not pad its input.
+    weights, bias = net.get_first_layer_params()
+    net.set_first_layer_params(weights, bias - np.tensordot(weights, image_mean, axes=([1], [0])).sum(axis=(1, 2)))
+    net.input_offset = None
+
+
+def preprocess_image(net, image, net_input):
+    # Write uint8 BGR (HxWx3) image transposed and mean-subtracted into the (3xH'xW') network input in one pass.
+    # If the network input is larger than the image, the remainder is filled with the mean color (zero input).
+    height, width = image.shape[:2]
+    source = image.transpose((2, 0, 1))
+    if net.input_offset is None:
+        net_input[:, :height, :width] = source
+        padding_value = image_mean.reshape((3, 1, 1))
+    else:
+        np.subtract(source, net.input_offset, out=net_input[:, :height, :width])
+        padding_value = 0
+    net_input[:, height:, :] = padding_value
+    net_input[:, :height, width:] = padding_value
+
+
+def get_bucket_shape(image_shape, bucket_size):
+    # Round (width, height) up to the next multiple of the bucket size
+    if not bucket_size:
+        return image_shape
+    return tuple(((v + bucket_size - 1) // bucket_size) * bucket_size for v in image_shape)
+
+
+def get_output_size(net, input_size):
+    net.reshape_input((1, 3, input_size, input_size))
+    return net.forward(net.output_name).shape[2]
 
 
-def get_net_margin(net):
-    # Determine margin of data not included in the FCN: Just call forward once and check the in/out size
-    input_shape = net.blobs['data'].shape
-    output = net.forward()
-    output_shape = output[net.output_name].shape
-    margin = (input_shape[2] - output_shape[2]*net.stride)//2
-    return margin
+def get_unpadded_output_size(net, size):
+    # Output size of the net for an unpadded input dimension. Pooling rounds up, so this can be one more than
+    # (size - 2 * margin) // stride. Output sizes repeat with the stride, so one probe per remainder is cached.
+    remainder = size % net.stride
+    if remainder not in net.output_size_offsets:
+        probe_size = (net_probe_size // net.stride) * net.stride + remainder
+        net.output_size_offsets[remainder] = get_output_size(net, probe_size) - probe_size // net.stride
+    return net.output_size_offsets[remainder] + size // net.stride
+
+
+def get_net_margin_and_stride(net):
+    # Determine stride and margin of data not included in the FCN from the output sizes of two small inputs
+    output_size = get_output_size(net, net_probe_size)
+    stride = net_probe_size // (get_output_size(net, net_probe_size * 2) - output_size)
+    margin = (net_probe_size - output_size * stride) // 2
+    return margin, stride
 
 
 def process_image(net, image, allow_undersize=False, verbose=True):
-    image_shape = (image.shape[1], image.shape[0])
+    return process_images_batch(net, [image], allow_undersize=allow_undersize, verbose=verbose)[0]
+
+
+def process_images_batch(net, images, allow_undersize=False, verbose=True):
+    # Process a list of images of identical shape in one forward pass. Returns one probability map per image.
+    image_shape = (images[0].shape[1], images[0].shape[0])
     min_size = net.margin * 2 + net.stride * 2
     if verbose:
-        print ('Processing image shaped %s' % str(image.shape)),
+        print ('Processing %d image(s) shaped %s' % (len(images), str(images[0].shape))),
+    if any(image.shape != images[0].shape for image in images):
+        raise RuntimeError('Batched images must have identical shapes.')
     if not allow_undersize:
         if image_shape[0] < min_size or image_shape[1] < min_size:
             raise RuntimeError('Image too small (min size %dx%d pixels)' % (min_size, min_size))
-    if net.input_size != image_shape:
-        net.input_size = image_shape
-        init_model_transformer(net)
-    transformed_image = net.transformer.preprocess('data', image)
-    net.blobs['data'].data[0, ...] = transformed_image
-    output = net.forward()
-    probs = output[net.output_name][0]
+    # Undersized inputs (validation crops) are never padded
+    input_shape = image_shape if allow_undersize else get_bucket_shape(image_shape, net.bucket_size)
+    if input_shape != image_shape:
+        # Outputs of the padded input are cropped to the shape the unpadded image would give (probes the net, so
+        # before the input is set up)
+        output_shape = [get_unpadded_output_size(net, v) for v in image_shape]
+    net.input_size = input_shape
+    net.reshape_input((len(images), 3, input_shape[1], input_shape[0]))
+    net_input = net.get_input_data()
+    for i, image in enumerate(images):
+        preprocess_image(net, image, net_input[i])
+    output = net.forward(net.output_name)
+    if len(images) * input_shape[0] * input_shape[1] > net.peak_input_size:
+        net.peak_input_size = len(images) * input_shape[0] * input_shape[1]
+        net.peak_blobs_bytes = max(net.peak_blobs_bytes, net.get_blobs_bytes())
     if verbose:
         print 'Done.'
-    return np.transpose(probs[1,:,:])
+    probs_list = []
+    for probs in output:
+        # Copy out of the output blob, which is overwritten by the next forward pass
+        probs = np.array(np.transpose(probs[1,:,:]))
+        if input_shape != image_shape:
+            # Crop outputs that depend on the padded border
+            probs = probs[:output_shape[0], :output_shape[1]]
+        probs_list.append(probs)
+    return probs_list
 
 
-def process_image_file(net, image_filename_full, heatmap_filename_full=None, crop=False, verbose=True, scales=None):
-    image = caffe.io.load_image(image_filename_full)
+def get_tile_ranges(length, tile_size, margin, stride):
+    # Split one image dimension into overlapping tiles that are aligned to the network stride.
+    # Returns a list of (input_start, input_end, output_skip, output_take) tuples. Interior tile borders get an
+    # additional net.margin of context on each side, so border effects of padded inner layers are cropped away.
+    context = int(np.ceil(float(margin) / stride))
+    full_tile_outputs = (tile_size - 2 * margin) // stride
+    if full_tile_outputs - 2 * context < 1:
+        raise RuntimeError('Tile size %d too small for network margin %d.' % (tile_size, margin))
+    ranges = []
+    output_start = 0
+    while True:
+        input_start = max(0, (output_start - context) * stride)
+        if input_start + tile_size >= length:
+            # Last tile: Align to the end of the image and keep all remaining outputs
+            input_start = max(0, -(-(length - tile_size) // stride) * stride)
+            ranges.append((input_start, length, output_start - input_start // stride, None))
+            break
+        input_end = input_start + tile_size
+        output_skip = output_start - input_start // stride
+        output_take = (input_end - input_start - 2 * margin) // stride - output_skip - context
+        ranges.append((input_start, input_end, output_skip, output_take))
+        output_start += output_take
+    return ranges
+
+
+def process_image_tiled(net, image, tile_size, allow_undersize=False, verbose=True):
+    # Process image in overlapping tiles and stitch the probability maps. Memory usage depends on tile size only.
+    x_ranges = get_tile_ranges(image.shape[1], tile_size, net.margin, net.stride)
+    y_ranges = get_tile_ranges(image.shape[0], tile_size, net.margin, net.stride)
     if verbose:
-        print 'process_image_file %s shape %s' % (image_filename_full, image.shape)
+        print 'Processing image shaped %s in %dx%d tiles' % (str(image.shape), len(x_ranges), len(y_ranges))
+    columns = []
+    for x0, x1, x_skip, x_take in x_ranges:
+        pieces = []
+        for y0, y1, y_skip, y_take in y_ranges:
+            tile_probs = process_image(net, image[y0:y1, x0:x1, :], allow_undersize=allow_undersize, verbose=False)
+            x_end = None if x_take is None else x_skip + x_take
+            y_end = None if y_take is None else y_skip + y_take
+            pieces.append(tile_probs[x_skip:x_end, y_skip:y_end])
+        columns.append(np.concatenate(pieces, axis=1))
+    return np.concatenate(columns, axis=0)
+
+
+def process_image_any_size(net, image, allow_undersize=False, verbose=True):
+    # Process image in one pass if it fits, otherwise in tiles
+    if max_image_size is not None and (image.shape[0] > max_image_size or image.shape[1] > max_image_size):
+        return process_image_tiled(net, image, max_image_size, allow_undersize=allow_undersize, verbose=verbose)
+    return process_image(net, image, allow_undersize=allow_undersize, verbose=verbose)
+
+
+def process_image_files_batch(net, image_filenames_full, scale=1.0, verbose=True):
+    # Process image files of identical size at the same scale in one forward pass. Returns one result per image.
+    width, height = get_image_size(image_filenames_full[0])
+    input_shape = (height, width)
+    zimages = [get_image_level(fn, scale) for fn in image_filenames_full]
+    if max_image_size is not None and max(zimages[0].shape[:2]) > max_image_size:
+        # Too large to batch: Process in tiles one by one
+        probs_list = [process_image_any_size(net, zimage, verbose=verbose) for zimage in zimages]
+    else:
+        probs_list = process_images_batch(net, zimages, verbose=verbose)
+    return [{'probs': probs, 'scale': scale, 'input_shape': input_shape} for probs in probs_list]
+
+
+def load_center_crop(image_filename_full, size):
+    # Decode only the center region of the given size (height, width) of an image file
+    width, height = get_image_size(image_filename_full)
+    x0 = max(0, (width - size[1]) // 2)
+    y0 = max(0, (height - size[0]) // 2)
+    return load_image(image_filename_full, region=(x0, y0, min(width, x0 + size[1]), min(height, y0 + size[0])))
+
+
+def get_center_crop(image, size):
+    y0 = max(0, (image.shape[0] - size[0]) // 2)
+    x0 = max(0, (image.shape[1] - size[1]) // 2)
+    return image[y0:y0 + size[0], x0:x0 + size[1], :]
+
+
+def estimate_image_scale(net, image, scales, verbose=True):
+    # Pick the best scale from a forward pass on a small center crop per candidate scale, so the full image has to
+    # be zoomed and processed only once. Score is the 95th percentile of the output (i.e. confident detections).
+    best_score = -np.inf
+    best_scale = scales[0]
+    for zscale in scales:
+        crop_size = int(np.ceil(scale_probe_size / zscale))
+        zcrop = resize_image(get_center_crop(image, (crop_size, crop_size)), zscale)
+        zprobs = process_image(net, zcrop, allow_undersize=True, verbose=False)
+        if not zprobs.size:
+            continue
+        score = np.percentile(zprobs, 95)
+        if verbose:
+            print 'estimate_image_scale x%.1f score %.3f' % (zscale, score)
+        if score > best_score:
+            best_score = score
+            best_scale = zscale
+    return best_scale
+
+
+def save_heatmap(heatmap_filename_full, data):
+    np.savez_compressed(heatmap_filename_full, probs=data['probs'], scale=data['scale'])
+
+
+def process_image_file(net, image_filename_full, heatmap_filename_full=None, crop=False, verbose=True, scales=None):
+    # Only the image level that is processed is decoded. Full resolution is not loaded for other scales.
     if crop:
-        h, w = net.original_shape[2:4]
-        if image.shape[0] > h:
-            y0 = (image.shape[0] - h) // 2
-            y1 = y0 + h
-        else:
-            y0 = 0
-            y1 = image.shape[0]
-        if image.shape[1] > w:
-            x0 = (image.shape[1] - w) // 2
-            x1 = x0 + w
-        else:
-            x0 = 0
-            x1 = image.shape[1]
-        image = image[y0:y1,x0:x1,:]
+        # Only decode the center region that is processed
+        image = load_center_crop(image_filename_full, net.original_shape[2:4])
+        input_shape = image.shape[:2]
+    else:
+        width, height = get_image_size(image_filename_full)
+        input_shape = (height, width)
+    if verbose:
+        print 'process_image_file %s shape %s' % (image_filename_full, str(input_shape))
     if scales is not None:
         assert not crop
-        best_score = -np.inf
-        probs = None
-        for zscale in scales:
-            print 'process_image_file scale', zscale
-            if zscale > 1.0:
-                if image.shape[0] * zscale > max_image_size or image.shape[1] * zscale > max_image_size:
-                    continue
-            if zscale == 1.0:
-                zimage = image
-            else:
-                zimage = zoom(image, (zscale, zscale, 1))
-            zprobs = process_image(net, zimage, allow_undersize=crop, verbose=verbose)
-            score = np.percentile(np.reshape(zprobs, (-1,)), 0.95)
-            if score > best_score:
-                probs = zprobs
-                scale = zscale
-        if probs is None:
-            raise RuntimeError('Image too large for this network (max %dx%d)' % ((int(max_image_size/scales[0]),)*2))
+        if len(scales) > 1:
+            # Probe crops of all scales fit into the center region needed at the smallest scale
+            probe_size = int(np.ceil(scale_probe_size / min(scales)))
+            probe_image = load_center_crop(image_filename_full, (probe_size, probe_size))
+            scale = estimate_image_scale(net, probe_image, scales, verbose=verbose)
+        else:
+            scale = scales[0]
+        if verbose:
+            print 'process_image_file scale', scale
+        probs = process_image_any_size(net, get_image_level(image_filename_full, scale), allow_undersize=crop,
+                                       verbose=verbose)
     else:
         if verbose:
             print 'process_image_file default scale (1.0)'
-        probs = process_image(net, image, allow_undersize=crop, verbose=verbose)
+        if not crop:
+            image = get_image_level(image_filename_full)
+        probs = process_image_any_size(net, image, allow_undersize=crop, verbose=verbose)
         scale = 1.0
     if verbose:
         print ('Probs shape x%.1f = %s' % (scale, str(probs.shape))),
     output = {
         'probs': probs,
         'scale': scale,
-        'input_shape': image.shape[:2],
+        'input_shape': input_shape,
     }
     if heatmap_filename_full:
         if verbose:
             print 'process_image_file saving heatmap'
-        np.savez_compressed(heatmap_filename_full, probs=probs, scale=scale)
+        save_heatmap(heatmap_filename_full, output)
     if verbose:
         print 'process_image_file done %s' % image_filename_full
     return output
@@ -144,16 +317,25 @@ def process_image_file(net, image_filename_full, heatmap_filename_full=None, cro
 def rgb2gray(rgb):
     return np.dot(rgb[..., :3], [0.299, 0.587, 0.114])
 
+
 def plot_heatmap(image_filename_full, heatmap_filename_full, heatmap_image_filename_full):
-    image = caffe.io.load_image(image_filename_full)
+    image = get_image_level(image_filename_full)
     data = np.load(heatmap_filename_full)
-    probs = np.array(data['probs'])
-    scale = float(data['scale'])
-    print 'plot_heatmap %s %.1f' % (str(probs.shape), scale)
+    hsv = render_heatmap(image, np.array(data['probs']), float(data['scale']))
+    if heatmap_image_filename_full is not None:
+        plt.imsave(heatmap_image_filename_full, hsv)
+    #plt.imshow(hsv)
+    #plt.show()
+    return hsv
+
+
+def render_heatmap(image, probs, scale):
+    # Overlay probability map on the grayscale (uint8 BGR) image. Returns an RGB float image.
+    print 'render_heatmap %s %.1f' % (str(probs.shape), scale)
     probs = probs.transpose()
 
     # Align probability map to input image
-    grayimage = rgb2gray(image)
+    grayimage = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float64) / 255.0
     stride = int(round(32 / scale))
     probs = cv2.resize(probs, (stride * probs.shape[1], stride * probs.shape[0]), interpolation=cv2.INTER_CUBIC)
     pad = [grayimage.shape[i] - probs.shape[i] for i in (0,1)]
@@ -171,9 +353,9 @@ def plot_heatmap(image_filename_full, heatmap_filename_full, heatmap_image_filen
 
     # Combine into one image
     hsv = plc.hsv_to_rgb(np.dstack((np.zeros(grayimage.shape), probs, grayimage)))
-
-    if heatmap_image_filename_full is not None:
-        plt.imsave(heatmap_image_filename_full, hsv)
-    #plt.imshow(hsv)
-    #plt.show()
     return hsv
+
+
+def heatmap_to_uint8(heatmap_image):
+    # Convert rendered heatmap to uint8 RGB, e.g. to draw detections onto it
+    return np.round(heatmap_image * 255).astype(np.uint8)
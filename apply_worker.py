@@ -3,26 +3,49 @@
 
 import time
 import os
+import socket
+import shutil
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import sys
+import signal
 import subprocess
 import traceback
+import threading
+import Queue
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
 import random
 
 from config import config, add_config_option
-from apply_fcn_caffe import process_image_file, plot_heatmap, prob_to_fc8
-from apply_fcn import load_model_by_record
+from apply_fcn_caffe import process_image_file, process_image_files_batch, save_heatmap, render_heatmap, \
+    heatmap_to_uint8, prob_to_fc8
+from image_pyramid import get_image_level
+from image_loader import get_file_hash
+from apply_fcn import load_model_by_record, NetCache, PrimaryModelLoader
 import db
-from stoma_counter import compute_stomata_positions, default_prob_threshold
-from image_measures import get_image_measures
+from stoma_counter_peaks import compute_stomata_positions_on_prob, default_prob_threshold
+from progress import ProgressReporter
+from recount import process_recounts
 
 
-def set_status(status_string, secondary=False):
-    status_id = 'sec_worker' if secondary else 'worker'
-    db.set_status(status_id, status_string)
+# Number of prepared sample batches buffered ahead of inference
+prefetch_batch_count = 2
+# Pipeline stages waiting on each other check for shutdown in this interval [s]
+queue_poll_seconds = 1.0
+
+# Identifies this worker process in sample claims
+worker_id = '%s-%d' % (socket.gethostname(), os.getpid())
+
+# Status updates are buffered and written to the database periodically
+progress_reporters = {False: ProgressReporter('worker', worker_id),
+                      True: ProgressReporter('sec_worker', worker_id)}
+
+
+def set_status(status_string, secondary=False, total=None, force=False):
+    progress_reporters[secondary].set_status(status_string, total=total, force=force)
 
 
 def get_status(secondary=False):
@@ -30,35 +53,171 @@ def get_status(secondary=False):
     return db.get_status(status_id)
 
 
-def process_primary_model(net, model):
-    # Process all unprocessed samples
+def process_primary_model(net, model, stop_event=None):
+    # Process all unprocessed samples. Samples are claimed, so multiple workers can run in parallel.
+    # Stops claiming new samples once stop_event is set. Returns IDs of the finished samples.
     model_id = model['_id']
-    unprocessed_samples = db.get_unprocessed_samples()
-    for qsample in unprocessed_samples:
-        process_image_sample(net=net,
-                             model_id=model_id,
-                             sample_id=qsample['_id'],
-                             is_primary_model=True)
+    set_status('Processing images...', total=db.get_unprocessed_sample_count())
+    return run_sample_pipeline(net, model_id, claim_sample_batches(config.worker_batch_size, stop_event),
+                               is_primary_model=True)
+
+
+def claim_sample_batches(batch_size, stop_event=None):
+    # Claim unprocessed samples in batches from the same dataset and of the same image size until none are left.
+    # The dataset of each batch is chosen by the fair share schedule, so large uploads do not block others.
+    scheduler = db.ClaimScheduler(worker_id)
+    while stop_event is None or not stop_event.is_set():
+        sample = scheduler.claim()
+        if sample is None:
+            return
+        sample_batch = [sample]
+        # Samples that failed before are processed alone, so they cannot take down other samples with them
+        while len(sample_batch) < batch_size and not sample.get('claim_attempts'):
+            sample = db.claim_unprocessed_sample(worker_id, query={'dataset_id': sample_batch[0]['dataset_id'],
+                                                                   'size': sample_batch[0]['size'],
+                                                                   'claim_attempts': {'$not': {'$gt': 0}}})
+            if sample is None:
+                break
+            sample_batch.append(sample)
+        yield sample_batch
+
+
+def renew_claims_forever():
+    # Heartbeat thread: Keep claims of this worker alive while it is running
+    while True:
+        time.sleep(db.default_claim_lease_seconds / 4)
+        try:
+            db.renew_sample_claims(worker_id)
+            db.renew_queue_claims(worker_id)
+        except:
+            traceback.print_exc()
+
+
+def start_claim_heartbeat():
+    heartbeat_thread = threading.Thread(target=renew_claims_forever)
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+
+def run_sample_pipeline(net, model_id, sample_batches, is_primary_model):
+    # Staged pipeline: A prefetch thread looks up and decodes sample batches, this thread runs inference (it owns the
+    # net) and a thread pool does the post-processing. Bounded queues between stages limit memory usage.
+    # Returns IDs of the finished samples.
+    finished_sample_ids = []
+    # On shutdown (e.g. SIGTERM while this thread waits for a batch), stopping is set, so the prefetch thread does not
+    # block forever on the full queue.
+    prepared_batches = Queue.Queue(maxsize=prefetch_batch_count)
+    stopping = threading.Event()
+
+    def put_prepared(jobs):
+        # Returns False if the pipeline is stopping
+        while not stopping.is_set():
+            try:
+                prepared_batches.put(jobs, timeout=queue_poll_seconds)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def prefetch():
+        try:
+            for sample_batch in sample_batches:
+                if stopping.is_set():
+                    break
+                # Samples of a batch come from the same dataset
+                dataset_settings = db.get_dataset_settings(sample_batch[0]['dataset_id'])
+                jobs = [prepare_image_sample(model_id, s, is_primary_model, dataset_settings) for s in sample_batch]
+                if not put_prepared([job for job in jobs if job is not None]):
+                    break
+        finally:
+            put_prepared(None)
+
+    prefetch_thread = threading.Thread(target=prefetch)
+    prefetch_thread.daemon = True
+    prefetch_thread.start()
+    postprocess_pool = ThreadPool(config.worker_postprocess_threads)
+    postprocess_slots = threading.BoundedSemaphore(config.worker_postprocess_threads * 2)
+    result_writer = db.ResultWriter(config.worker_batch_size)
+
+    def postprocess(job):
+        try:
+            if finish_image_sample(net.name, net.margin, model_id, job, result_writer):
+                finished_sample_ids.append(job['sample']['_id'])
+            else:
+                db.release_sample_claim(job['sample']['_id'], worker_id)
+        finally:
+            postprocess_slots.release()
+
+    try:
+        while True:
+            # Wait with timeout, so signals are handled while waiting
+            try:
+                jobs = prepared_batches.get(timeout=queue_poll_seconds)
+            except Queue.Empty:
+                continue
+            if jobs is None:
+                break
+            infer_image_samples(net, jobs)
+            for job in jobs:
+                if job.get('data') is not None or job['cached_annotation'] is not None:
+                    postprocess_slots.acquire()
+                    postprocess_pool.apply_async(postprocess, (job,))
+    finally:
+        stopping.set()
+        postprocess_pool.close()
+        postprocess_pool.join()
+        prefetch_thread.join()
+        result_writer.flush()
+    return finished_sample_ids
+
+
+def infer_image_samples(net, jobs):
+    # Run the CNN on prepared samples of identical image size and zoom. Stores results in the job records.
+    # Processed in one batch if possible. Otherwise, or if the batch fails, samples are processed one by one.
+    # Samples with a cached result are skipped.
+    jobs = [job for job in jobs if job['cached_annotation'] is None]
+    claimed_ids = [job['sample']['_id'] for job in jobs if job['is_primary_model']]
+    if claimed_ids:
+        db.mark_samples_started(claimed_ids, worker_id)
+    image_zoom_values = jobs[0]['image_zoom_values'] if jobs else None
+    if len(jobs) > 1 and (image_zoom_values is None or len(image_zoom_values) == 1):
+        scale = 1.0 if image_zoom_values is None else image_zoom_values[0]
+        try:
+            batch_data = process_image_files_batch(net, [job['image_filename_full'] for job in jobs], scale=scale)
+            for job, data in zip(jobs, batch_data):
+                job['data'] = data
+            return
+        except:
+            print 'Batch processing failed. Processing samples individually.'
+            traceback.print_exc()
+    for job in jobs:
+        try:
+            job['data'] = process_image_file(net, job['image_filename_full'], scales=job['image_zoom_values'])
+        except:
+            error_string = traceback.format_exc()
+            db.set_sample_error(job['sample']['_id'], "Processing error:\n" + str(error_string))
 
 
 def process_secondary_models(net, model):
-    # Process all unprocessed samples
+    # Process all queued samples. Queue items are claimed in batches, so multiple workers can drain the queue.
     model_id = model['_id']
     while True:
-        unprocessed_samples = list(db.get_queued_samples(model_id=model_id))
-        if not len(unprocessed_samples):
+        queued_samples = db.claim_queued_samples(model_id, worker_id, config.worker_batch_size)
+        if not queued_samples:
             break
-        qsample = unprocessed_samples[0]
-        db.unqueue_sample(queue_item_id=qsample['_id'])
-        if 'sample_id' in qsample:
-            process_image_sample(net=net,
-                                 model_id=model_id,
-                                 sample_id=qsample['sample_id'],
-                                 is_primary_model=False)
-        elif 'validation_model_id' in qsample:
-            process_validation_set(net, model, db.get_model_by_id(qsample['validation_model_id']))
-        else:
-            print 'Invalid sample:', qsample
+        for qsample in queued_samples:
+            try:
+                if 'sample_id' in qsample:
+                    process_image_sample(net=net,
+                                         model_id=model_id,
+                                         sample_id=qsample['sample_id'],
+                                         is_primary_model=False)
+                elif 'validation_model_id' in qsample:
+                    process_validation_set(net, model, db.get_model_by_id(qsample['validation_model_id']))
+                else:
+                    print 'Invalid sample:', qsample
+            finally:
+                db.unqueue_sample(queue_item_id=qsample['_id'])
 
 
 # Process all training and validation images of a model training run
@@ -66,19 +225,17 @@ def process_validation_set(net, net_model, validation_set_model, sample_limit=10
     # List images
     sample_path = os.path.join(config.get_train_data_path(), str(validation_set_model['_id']), 'samples')
     for subset in 'test', 'train':
-        set_status('Processing model %s %s set %s...' % (net_model['name'], subset, validation_set_model['name']))
         imagelist_filename = os.path.join(sample_path, subset + '.txt')
         image_list = [s.split(' ') for s in open(imagelist_filename, 'rt').read().splitlines()]
         n_images = len(image_list)
         if n_images > sample_limit:
             image_list = random.sample(image_list, sample_limit)
             n_images = sample_limit
+        set_status('Processing model %s %s set %s...' % (net_model['name'], subset, validation_set_model['name']),
+                   secondary=True, total=n_images)
         confusion_matrix = [[0, 0], [0, 0]]
         predictions = [{}, {}]
         for i, (image_path, true_label_string) in tqdm(enumerate(image_list), total=len(image_list)):
-            set_status('Processing model %s %s set %s... (%d/%d)' % (net_model['name'], subset,
-                                                                     validation_set_model['name'],
-                                                                     i, n_images))
             image_filename_full = os.path.join(sample_path, image_path)
             data = process_image_file(net, image_filename_full, crop=True, verbose=False)
             probs = data['probs']
@@ -86,6 +243,7 @@ def process_validation_set(net, net_model, validation_set_model, sample_limit=10
             true_label = int(true_label_string)
             confusion_matrix[true_label][prediction] += 1
             predictions[true_label][image_path] = probs.item()
+            progress_reporters[True].add_done()
         print '%s %s %s confusion_matrix: %s' % (net_model['name'], subset, validation_set_model['name'],
                                                  confusion_matrix)
         # Get worst predictions for both classes
@@ -111,9 +269,22 @@ def process_image_sample(net, model_id, sample_id, is_primary_model):
     sample = db.get_sample_by_id(sample_id)
     if sample is None:
         return
-    dataset_info = db.get_dataset_by_id(sample['dataset_id'])
-    image_zoom_values = default_image_zoom_values.get(dataset_info.get('image_zoom'))
-    threshold_prob_val = dataset_info.get('threshold_prob')
+    job = prepare_image_sample(model_id, sample, is_primary_model, db.get_dataset_settings(sample['dataset_id']))
+    if job is None:
+        return
+    infer_image_samples(net, [job])
+    if job.get('data') is not None or job['cached_annotation'] is not None:
+        result_writer = db.ResultWriter(1)
+        finish_image_sample(net.name, net.margin, model_id, job, result_writer)
+        result_writer.flush()
+
+
+def prepare_image_sample(model_id, sample, is_primary_model, dataset_settings):
+    # Determine processing settings and decode the sample image into the pyramid cache.
+    # Returns None if it cannot be processed.
+    dataset_settings = dataset_settings or {}
+    image_zoom_values = default_image_zoom_values.get(dataset_settings.get('image_zoom'))
+    threshold_prob_val = dataset_settings.get('threshold_prob')
     if not threshold_prob_val:
         threshold_prob = default_prob_threshold
     else:
@@ -123,83 +294,207 @@ def process_image_sample(net, model_id, sample_id, is_primary_model):
     image_filename_full = os.path.join(config.get_server_image_path(), image_filename)
     if not os.path.isfile(image_filename_full):
         db.set_sample_error(sample['_id'], 'File does not exist: "%s".' % image_filename_full)
-        return
+        return None
     basename, ext = os.path.splitext(image_filename)
     if not ext.lower() in config.image_extensions:
         db.set_sample_error(sample['_id'], 'Unknown file extension "%s".' % ext)
-        return
+        return None
+    job = {'sample': sample,
+           'is_primary_model': is_primary_model,
+           'image_zoom_values': image_zoom_values,
+           'threshold_prob': threshold_prob,
+           'image_filename_full': image_filename_full,
+           'basename': basename}
     try:
-        # Lots of saving and loading here. TODO: Should be optimized to be done all in memory.
+        # Identical images processed before with the same settings do not need to be processed again
+        if not sample.get('content_hash'):
+            sample['content_hash'] = get_file_hash(image_filename_full)
+            db.set_sample_content_hash(sample['_id'], sample['content_hash'])
+        job['cached_annotation'] = find_cached_annotation(model_id, job)
+        if job['cached_annotation'] is None:
+            # Only the level inference runs on (with multiple zoom values, the scale is picked during inference)
+            if image_zoom_values is None:
+                get_image_level(image_filename_full)
+            elif len(image_zoom_values) == 1:
+                get_image_level(image_filename_full, image_zoom_values[0])
+    except:
+        error_string = traceback.format_exc()
+        db.set_sample_error(sample['_id'], "Processing error:\n" + str(error_string))
+        return None
+    return job
+
+
+def find_cached_annotation(model_id, job):
+    # Find reusable result of the model on identical image content. Results whose heatmap files have been deleted
+    # are evicted from the cache.
+    for annotation in db.find_cached_machine_annotations(job['sample']['content_hash'], model_id,
+                                                         job['image_zoom_values'], job['threshold_prob']):
+        if annotation['sample_id'] == job['sample']['_id']:
+            continue
+        heatmap_filenames_full = [os.path.join(config.get_server_heatmap_path(), annotation[k])
+                                  for k in ('heatmap_filename', 'heatmap_image_filename')]
+        if all(os.path.isfile(fn) for fn in heatmap_filenames_full):
+            return annotation
+        db.evict_cached_machine_annotation(annotation['_id'])
+    return None
+
+
+def finish_image_sample(net_name, net_margin, model_id, job, result_writer):
+    # Post-process CNN output of a sample: Render heatmap, count stomata and write all results. Database records are
+    # written through result_writer (releasing the claim of primary samples). Returns False on error.
+    sample = job['sample']
+    data = job.get('data')
+    image_filename_full = job['image_filename_full']
+    try:
+        # All intermediates are kept in memory. Each artifact is written once at the end.
         # Determine output file paths
-        heatmap_filename = os.path.join(net.name, basename + '_heatmap.npz')
+        heatmap_filename = os.path.join(net_name, job['basename'] + '_heatmap.npz')
         heatmap_filename_full = os.path.join(config.get_server_heatmap_path(), heatmap_filename)
         if not os.path.isdir(os.path.dirname(heatmap_filename_full)):
             os.makedirs(os.path.dirname(heatmap_filename_full))
-        heatmap_image_filename = os.path.join(net.name, basename + '_heatmap.jpg')
+        heatmap_image_filename = os.path.join(net_name, job['basename'] + '_heatmap.jpg')
         heatmap_image_filename_full = os.path.join(config.get_server_heatmap_path(), heatmap_image_filename)
-        # Process image
-        data = process_image_file(net, image_filename_full, heatmap_filename_full, scales=image_zoom_values)
-        plot_heatmap(image_filename_full, heatmap_filename_full, heatmap_image_filename_full)
-        if 'imq_entropy' not in sample:
-            imq = get_image_measures(image_filename_full)
-            db.set_image_measures(sample['_id'], imq)
-        positions = [] # Computed later
-        machine_annotation = db.add_machine_annotation(sample['_id'], model_id, heatmap_filename,
-                                                       heatmap_image_filename, positions,
-                                                       margin=int(net.margin / data['scale']),
-                                                       is_primary_model=is_primary_model,
-                                                       scale=data['scale'])
+        cached_annotation = job['cached_annotation']
+        if cached_annotation is not None:
+            # Reuse result of identical image: Copy heatmap files, so they are independent of the other sample
+            print 'Reusing result of identical image for %s.' % sample['filename']
+            shutil.copyfile(os.path.join(config.get_server_heatmap_path(), cached_annotation['heatmap_filename']),
+                            heatmap_filename_full)
+            shutil.copyfile(os.path.join(config.get_server_heatmap_path(),
+                                         cached_annotation['heatmap_image_filename']), heatmap_image_filename_full)
+            result_writer.add_machine_annotation(sample['_id'], model_id, heatmap_filename, heatmap_image_filename,
+                                                 cached_annotation['positions'], margin=cached_annotation['margin'],
+                                                 is_primary_model=job['is_primary_model'],
+                                                 scale=cached_annotation['scale'],
+                                                 content_hash=sample['content_hash'],
+                                                 image_zoom_values=job['image_zoom_values'],
+                                                 threshold_prob=job['threshold_prob'],
+                                                 release_claim=job['is_primary_model'])
+            progress_reporters[not job['is_primary_model']].add_done(sample['dataset_id'])
+            return True
+        heatmap_image = heatmap_to_uint8(render_heatmap(get_image_level(image_filename_full), data['probs'],
+                                                        data['scale']))
         # Count stomata
-        heatmap_image = plt.imread(heatmap_image_filename_full)
-        positions = compute_stomata_positions(machine_annotation, heatmap_image, plot=False,
-                                              prob_threshold=threshold_prob)
-        db.update_machine_annotation_positions(sample['_id'], machine_annotation['_id'], positions,
-                                               is_primary_model=is_primary_model)
+        margin = int(net_margin / data['scale'])
+        positions = compute_stomata_positions_on_prob(probs=data['probs'],
+                                                      scale=data['scale'],
+                                                      margin=margin,
+                                                      sample_size=sample['size'],
+                                                      heatmap_image=heatmap_image,
+                                                      plot=False,
+                                                      prob_threshold=job['threshold_prob'])
+        # Write results
+        save_heatmap(heatmap_filename_full, data)
         plt.imsave(heatmap_image_filename_full, heatmap_image)
+        result_writer.add_machine_annotation(sample['_id'], model_id, heatmap_filename, heatmap_image_filename,
+                                             positions, margin=margin, is_primary_model=job['is_primary_model'],
+                                             scale=data['scale'], content_hash=sample['content_hash'],
+                                             image_zoom_values=job['image_zoom_values'],
+                                             threshold_prob=job['threshold_prob'],
+                                             release_claim=job['is_primary_model'])
+        progress_reporters[not job['is_primary_model']].add_done(sample['dataset_id'])
         print 'Finished record.'
+        return True
     except:
         error_string = traceback.format_exc()
-        db.set_sample_error(sample['_id'], "Processing error:\n" +str(error_string))
+        db.set_sample_error(sample['_id'], "Processing error:\n" + str(error_string))
+        return False
 
 
 EXITCODE_RESTART = 55
 
 
+def find_queued_model():
+    # Find a trained model with queued samples
+    for model in db.get_models(details=False, status=db.model_status_trained):
+        if db.has_queued_samples(model['_id']):
+            return model
+    return None
+
+
+def secondary_worker_process():
+    # Long-lived process switching between models as needed. Loaded nets stay resident in the cache.
+    net_cache = NetCache(config.worker_net_cache_mb * 1024 * 1024)
+    listener = db.EventListener([db.event_queue, db.event_models])
+    while True:
+        set_status('Waiting for model/images...', secondary=True, force=True)
+        model = find_queued_model()
+        if model is None:
+            listener.wait(db.event_poll_seconds)
+            continue
+        set_status('Loading model %s...' % model['name'], secondary=True)
+        net = net_cache.get(model)
+        process_secondary_models(net, model)
+
+
+def process_recounts_forever(pool, batch_size, current_model):
+    # Recount thread: Handle recounts as they are queued, so they do not wait until the image backlog is processed.
+    # Counts with the model currently in current_model['model'].
+    listener = db.EventListener([db.event_samples])
+    while True:
+        try:
+            process_recounts(pool, worker_id, current_model['model']['_id'], batch_size)
+        except:
+            traceback.print_exc()
+        listener.wait(db.event_poll_seconds)
+
+
+def start_recount_thread(pool, batch_size, current_model):
+    recount_thread = threading.Thread(target=process_recounts_forever, args=(pool, batch_size, current_model))
+    recount_thread.daemon = True
+    recount_thread.start()
+
+
 def worker_process(secondary=False):
     # Infinite worker process
+    recount_pool = None
     try:
         set_status('Startup...', secondary=secondary)
-        model = None
-        # First find network to load
+        db.ensure_sample_indexes()
+        db.ensure_machine_annotation_indexes()
+        start_claim_heartbeat()
         if secondary:
-            set_status('Waiting for model/images...', secondary=secondary)
-            while model is None:
-                models = db.get_models(details=False, status=db.model_status_trained)
-                for cmodel in models:
-                    if len(list(db.get_queued_samples(model_id=cmodel['_id']))):
-                        model = cmodel
-                        break
-                if model is None:
-                    time.sleep(1)
-        else:
-            model = db.get_primary_model()
+            secondary_worker_process()
+        # Processes for recounting are forked before the network is loaded
+        recount_processes = config.worker_recount_processes or cpu_count()
+        recount_pool = Pool(recount_processes)
+        # First find network to load
+        model = db.get_primary_model()
         set_status('Loading model %s...' % model['name'], secondary=secondary)
         net = load_model_by_record(model)
+        # A new primary model is loaded in the background while processing continues with the current one
+        model_loader = PrimaryModelLoader(model)
+        model_loader.start_watching()
+        current_model = {'model': model}
+        start_recount_thread(recount_pool, recount_processes * 2, current_model)
         # Then find samples to process
+        listener = db.EventListener([db.event_samples, db.event_models])
+        # Samples finished with the current model since the primary model was changed in the database
+        old_model_sample_ids = []
         while True:
-            if secondary:
-                process_secondary_models(net, model)
-                # Secondary model: Always quit after processing is done; going back to model search.
-                break
-            else:
-                process_primary_model(net, model)
-                # Did the primary model change?
-                if db.get_primary_model()['_id'] != model['_id']:
-                    break
-                set_status('Waiting for images...', secondary=secondary)
-                time.sleep(1)
+            primary_model = db.get_primary_model()
+            if primary_model is not None and primary_model['_id'] == model['_id']:
+                # No switch pending: Samples finished so far are updated by set_primary_model
+                del old_model_sample_ids[:]
+            old_model_sample_ids += process_primary_model(net, model, stop_event=model_loader.ready)
+            if model_loader.ready.is_set():
+                model, net = model_loader.swap()
+                current_model['model'] = model
+                set_status('Switched to model %s.' % model['name'], secondary=secondary, force=True)
+                # Samples counted by the previous model during the switch are processed again
+                db.fix_primary_machine_annotations(old_model_sample_ids)
+                del old_model_sample_ids[:]
+                continue
+            set_status('Waiting for images...', secondary=secondary, force=True)
+            listener.wait(db.event_poll_seconds)
     finally:
-        set_status('offline', secondary=secondary)
+        if recount_pool is not None:
+            recount_pool.terminate()
+        if secondary:
+            db.release_queue_claims(worker_id)
+        else:
+            db.release_sample_claims(worker_id)
+        set_status('offline', secondary=secondary, force=True)
 
     # Trigger restart.
     return True
@@ -211,10 +506,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Epidermal worker process: Finds stomata in images.')
     parser.add_argument('--run', action='store_true', help='Run the actual process. Otherwise, start process as child.')
     parser.add_argument('--secondary', action='store_true', help='Monitor non-primary models.')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='CPU threads for inference and recounting (overrides worker_threads config).')
     add_config_option(parser)
 
     args = parser.parse_args()
+    if args.threads:
+        config.worker_threads = args.threads
+        config.worker_recount_processes = args.threads
     if args.run:
+        # Release claims when stopped by the supervisor
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         if worker_process(args.secondary):
             sys.exit(EXITCODE_RESTART)
     else:
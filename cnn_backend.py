@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Inference backends to run the FCN through pycaffe or the OpenCV DNN module
+
+import re
+import numpy as np
+import cv2
+
+try:
+    import caffe
+    has_caffe = True
+except ImportError:
+    print 'Error importing caffe. Only the OpenCV inference backend is available.'
+    has_caffe = False
+
+
+backend_names = ['caffe', 'opencv']
+
+
+class CaffeBackend:
+    # Network evaluated by pycaffe. Input data is written directly into the data blob.
+    backend_name = 'caffe'
+
+    def __init__(self, proto_fn, model_fn, gpu_index=0, threads=0):
+        if not has_caffe:
+            raise RuntimeError('caffe backend requested, but caffe is not installed.')
+        if gpu_index > 0:
+            caffe.set_mode_gpu()
+            caffe.set_device(gpu_index)
+        else:
+            caffe.set_mode_cpu()
+        self.net = caffe.Net(proto_fn, caffe.TEST, weights=model_fn)
+
+    def get_input_shape(self):
+        return tuple(self.net.blobs['data'].shape)
+
+    def reshape_input(self, shape):
+        self.net.blobs['data'].reshape(*shape)
+
+    def get_input_data(self):
+        return self.net.blobs['data'].data
+
+    def forward(self, output_name):
+        return self.net.forward()[output_name]
+
+    def get_blobs_bytes(self):
+        # Memory of the activation blobs at the current input shape (float32)
+        return sum(blob.count for blob in self.net.blobs.itervalues()) * 4
+
+    def get_first_layer_params(self):
+        weights, bias = self.net.params.values()[0][:2]
+        return weights.data, bias.data
+
+    def set_first_layer_params(self, weights, bias):
+        params = self.net.params.values()[0]
+        params[0].data[...] = weights
+        params[1].data[...] = bias
+
+
+def get_prototxt_input_shape(proto_fn):
+    # Parse shape of the input layer from the network definition (first four dims)
+    dims = re.findall(r'(?:dim|input_dim)\s*:\s*(\d+)', open(proto_fn, 'rt').read())
+    if len(dims) < 4:
+        raise RuntimeError('Could not determine input shape of network %s.' % proto_fn)
+    return tuple(int(d) for d in dims[:4])
+
+
+class OpenCVBackend:
+    # Network evaluated by the OpenCV DNN module on the CPU. Does not require caffe.
+    backend_name = 'opencv'
+
+    def __init__(self, proto_fn, model_fn, gpu_index=0, threads=0):
+        if threads > 0:
+            cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromCaffe(proto_fn, model_fn)
+        self.first_layer_id = [self.net.getLayerId(layer_name) for layer_name in self.net.getLayerNames()
+                               if self.net.getLayer(self.net.getLayerId(layer_name)).type == 'Convolution'][0]
+        self.input_data = np.zeros(get_prototxt_input_shape(proto_fn), dtype=np.float32)
+
+    def get_input_shape(self):
+        return self.input_data.shape
+
+    def reshape_input(self, shape):
+        if self.input_data.shape != tuple(shape):
+            self.input_data = np.zeros(shape, dtype=np.float32)
+
+    def get_input_data(self):
+        return self.input_data
+
+    def forward(self, output_name):
+        self.net.setInput(self.input_data)
+        return self.net.forward(output_name)
+
+    def get_blobs_bytes(self):
+        # Memory of the activation blobs at the current input shape
+        return self.net.getMemoryConsumption(self.input_data.shape)[1]
+
+    def get_first_layer_params(self):
+        return self.net.getParam(self.first_layer_id, 0), self.net.getParam(self.first_layer_id, 1).reshape((-1,))
+
+    def set_first_layer_params(self, weights, bias):
+        self.net.setParam(self.first_layer_id, 0, weights)
+        self.net.setParam(self.first_layer_id, 1, bias.reshape(self.net.getParam(self.first_layer_id, 1).shape))
+
+
+def load_backend(backend_name, proto_fn, model_fn, gpu_index=0, threads=0):
+    backends = {'caffe': CaffeBackend, 'opencv': OpenCVBackend}
+    if backend_name not in backends:
+        raise RuntimeError('Unknown inference backend "%s" (options: %s).' % (backend_name, ', '.join(backend_names)))
+    return backends[backend_name](proto_fn, model_fn, gpu_index=gpu_index, threads=threads)
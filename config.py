@@ -54,6 +54,15 @@ class Config:
         self.archive_extensions = ['.zip']
         self.max_image_file_size = 1024 * 1024 * 50 # 50MB
         self.worker_gpu_index = 0
+        self.worker_batch_size = 4
+        self.worker_postprocess_threads = 2
+        self.worker_backend = 'caffe'
+        self.worker_threads = 0
+        self.worker_net_cache_mb = 2048
+        self.image_measure_processes = 0
+        self.worker_recount_processes = 0
+        self.worker_max_sample_seconds = 600
+        self.worker_max_rss_mb = 0
 
         # Local source root
         self.src_path = os.path.dirname(__file__)
@@ -2,11 +2,16 @@
 # Image sample database. DB is connected on module import
 
 import os
+import time
+import threading
+import traceback
 import numpy as np
 import pymongo
+from pymongo.errors import CollectionInvalid
+from bson.objectid import ObjectId
 from config import config
 from hopkins import hopkins
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 client = pymongo.MongoClient(host=config.db_address, port=config.db_port)
@@ -19,6 +24,11 @@ datasets = epidermal_db['datasets']
 samples = epidermal_db['samples']
 
 # 'name' (str): Name to identify the dataset
+# 'date_last_claimed' (datetime): UTC time a worker last claimed a sample of this dataset (for fair scheduling)
+# 'processing_rates' (dict): Per worker {'rate': images/s, 'date': UTC time of measurement}
+
+# Processing rates of workers not reported for this long are removed [s]
+stale_processing_rate_seconds = 3600
 
 
 def get_dataset_info(s):
@@ -46,6 +56,11 @@ def get_datasets_by_user(user_id):
     return [get_dataset_info(s) for s in datasets.find({'deleted': False, 'user_id': user_id})]
 
 
+def get_dataset_settings(dataset_id):
+    # Processing settings of a dataset without the sample counts and user of get_dataset_by_id
+    return datasets.find_one({'_id': dataset_id}, {'image_zoom': True, 'threshold_prob': True})
+
+
 def get_dataset_by_id(dataset_id):
     return get_dataset_info(datasets.find_one({'_id': dataset_id}))
 
@@ -77,6 +92,28 @@ def access_dataset(dataset_id):
     datasets.update_one({'_id': dataset_id}, {"$set": {'date_accessed': datetime.now()}}, upsert=False)
 
 
+def set_dataset_processing_rate(dataset_id, worker_key, rate):
+    # Rate None removes the entry of the worker (it stopped working on the dataset). Entries of workers that stopped
+    # reporting without removing theirs (e.g. crashed) are removed as well.
+    now = datetime.utcnow()
+    if rate is None:
+        update = {"$unset": {'processing_rates.' + worker_key: ''}}
+    else:
+        update = {"$set": {'processing_rates.' + worker_key: {'rate': rate, 'date': now}}}
+    dataset = datasets.find_one_and_update({'_id': dataset_id}, update, projection={'processing_rates': True},
+                                           return_document=pymongo.ReturnDocument.AFTER)
+    min_date = now - timedelta(seconds=stale_processing_rate_seconds)
+    stale_keys = [key for key, r in ((dataset or {}).get('processing_rates') or {}).iteritems() if r['date'] < min_date]
+    if stale_keys:
+        datasets.update_one({'_id': dataset_id}, {"$unset": {'processing_rates.' + key: '' for key in stale_keys}})
+
+
+def get_dataset_processing_rate(dataset_info, max_age_seconds):
+    # Total processing rate [images/s] of all workers that recently reported progress on this dataset
+    min_date = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+    return sum(r['rate'] for r in (dataset_info.get('processing_rates') or {}).itervalues() if r['date'] >= min_date)
+
+
 def delete_dataset(dataset_id, recycle=True, delete_files=False):
     if recycle:
         access_dataset(dataset_id)
@@ -150,6 +187,40 @@ def fix_dataset_tags():
 # 'error_string' (str): Error string if there was a problem with the sample
 # 'size': array[2]: Image size [px]
 # 'date_added': datetime when the sample was uploaded
+# 'content_hash' (str): SHA-1 of the image file content
+# 'claim_owner' (str): ID of the worker currently processing the sample
+# 'claim_expires' (datetime): UTC time when the claim lease expires and other workers may take over the sample
+# 'claim_date' (datetime): UTC time when the sample was claimed
+# 'claim_started' (datetime): UTC time when the claiming worker started inference on it (to detect workers stuck on it)
+# 'claim_attempts' (int): Number of times processing of the sample was started without finishing or being released
+# 'imq_*' (float): Image quality measures (see image_measures.py)
+# 'recount' (id): Set while positions should be recounted from the stored heatmap (e.g. after a threshold change)
+# 'imq_computed' (bool): Image quality measures have been computed (or failed, see 'imq_error')
+# 'imq_claim_owner' (str), 'imq_claim_expires' (datetime): Claim by an image measure worker
+
+# Claims not renewed for this duration are taken over by other workers
+default_claim_lease_seconds = 120
+# Samples whose processing failed this many times (e.g. crashing or stalling the worker) are set to error
+max_sample_attempts = 3
+# Datasets with at most this many pending samples are considered interactive uploads and scheduled first
+interactive_sample_count = 10
+# Claim schedule (and quarantine) are recomputed at most this often [s]
+claim_schedule_seconds = 5.0
+
+
+def ensure_sample_indexes():
+    # Pending samples by dataset (claims, schedule, counts) and claims of a worker (heartbeat, release)
+    samples.create_index([('processed', pymongo.ASCENDING), ('error', pymongo.ASCENDING),
+                          ('dataset_id', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    samples.create_index([('claim_owner', pymongo.ASCENDING)])
+    samples.create_index([('claim_expires', pymongo.ASCENDING)])
+
+
+def get_unprocessed_sample_count(dataset_id=None):
+    query = {'processed': False, 'error': False}
+    if dataset_id is not None:
+        query['dataset_id'] = dataset_id
+    return samples.count(query)
 
 
 def get_unprocessed_samples(dataset_id=None):
@@ -159,6 +230,151 @@ def get_unprocessed_samples(dataset_id=None):
     return list(samples.find(query))
 
 
+def claim_unprocessed_sample(owner, lease_seconds=default_claim_lease_seconds, query=None):
+    # Atomically claim one unprocessed sample that is not claimed (or whose claim has expired) by another worker.
+    # Returns the claimed sample or None if there is nothing to do. Lease times are UTC to work across machines.
+    # Claiming alone does not count as an attempt (see mark_samples_started).
+    now = datetime.utcnow()
+    claim_query = {'processed': False, 'error': False, 'claim_attempts': {'$not': {'$gte': max_sample_attempts}},
+                   '$or': [{'claim_owner': None}, {'claim_expires': {'$lt': now}}]}
+    if query is not None:
+        claim_query.update(query)
+    return samples.find_one_and_update(claim_query,
+                                       {"$set": {'claim_owner': owner,
+                                                 'claim_date': now,
+                                                 'claim_started': None,
+                                                 'claim_expires': now + timedelta(seconds=lease_seconds)}},
+                                       sort=[('_id', pymongo.ASCENDING)],
+                                       return_document=pymongo.ReturnDocument.AFTER)
+
+
+def get_claim_schedule():
+    # Order datasets with claimable samples for fair sharing between users:
+    # Small (interactive) uploads first, then users with the fewest samples currently being processed, then the
+    # dataset that has waited longest since its last claim. Datasets without user count as their own user.
+    # Returns list of (dataset_id, is_interactive).
+    now = datetime.utcnow()
+    pending = samples.aggregate([{'$match': {'processed': False, 'error': False,
+                                             '$or': [{'claim_owner': None}, {'claim_expires': {'$lt': now}}]}},
+                                 {'$group': {'_id': '$dataset_id', 'count': {'$sum': 1}}}])
+    pending_counts = {r['_id']: r['count'] for r in pending}
+    if not pending_counts:
+        return []
+    active = samples.aggregate([{'$match': {'processed': False, 'claim_expires': {'$gte': now}}},
+                                {'$group': {'_id': '$dataset_id', 'count': {'$sum': 1}}}])
+    active_counts = {r['_id']: r['count'] for r in active}
+    dataset_records = {d['_id']: d for d in datasets.find({'_id': {'$in': pending_counts.keys() +
+                                                                             active_counts.keys()}},
+                                                          {'user_id': True, 'date_last_claimed': True})}
+
+    def get_owner(dataset_id):
+        user_id = dataset_records.get(dataset_id, {}).get('user_id')
+        return dataset_id if user_id is None else user_id
+
+    user_active_counts = {}
+    for dataset_id, count in active_counts.iteritems():
+        owner = get_owner(dataset_id)
+        user_active_counts[owner] = user_active_counts.get(owner, 0) + count
+
+    def get_priority(dataset_id):
+        last_claimed = dataset_records.get(dataset_id, {}).get('date_last_claimed') or datetime.min
+        return (pending_counts[dataset_id] > interactive_sample_count,
+                user_active_counts.get(get_owner(dataset_id), 0),
+                last_claimed)
+
+    return [(dataset_id, pending_counts[dataset_id] <= interactive_sample_count)
+            for dataset_id in sorted(pending_counts.keys(), key=get_priority)]
+
+
+def quarantine_failed_samples():
+    # Set samples to error that failed too often, so they do not keep crashing workers
+    now = datetime.utcnow()
+    samples.update_many({'processed': False, 'error': False, 'claim_attempts': {'$gte': max_sample_attempts},
+                         '$or': [{'claim_owner': None}, {'claim_expires': {'$lt': now}}]},
+                        {"$set": {'error': True, 'claim_owner': None, 'claim_expires': None,
+                                  'error_string': 'Processing failed %d times (worker crashed, timed out or ran out of '
+                                                  'memory). Sample quarantined.' % max_sample_attempts}})
+
+
+class ClaimScheduler:
+    # Claims unprocessed samples from the dataset that is next in line according to the fair share schedule.
+    # The schedule is computed at most every refresh_seconds instead of for each claim. In between, datasets are
+    # served round robin: A dataset that got a claim moves to the end of the schedule (interactive uploads keep their
+    # place) and datasets without claimable samples are dropped.
+
+    def __init__(self, owner, lease_seconds=default_claim_lease_seconds, refresh_seconds=claim_schedule_seconds):
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.refresh_seconds = refresh_seconds
+        self.schedule = []
+        self.refresh_time = None
+
+    def refresh(self):
+        quarantine_failed_samples()
+        self.schedule = get_claim_schedule()
+        self.refresh_time = time.time()
+
+    def claim_scheduled(self):
+        while self.schedule:
+            dataset_id, is_interactive = self.schedule[0]
+            sample = claim_unprocessed_sample(self.owner, self.lease_seconds, query={'dataset_id': dataset_id})
+            if sample is None:
+                del self.schedule[0]
+                continue
+            datasets.update_one({'_id': dataset_id}, {"$set": {'date_last_claimed': datetime.utcnow()}}, upsert=False)
+            if not is_interactive:
+                self.schedule.append(self.schedule.pop(0))
+            return sample
+        return None
+
+    def claim(self):
+        # Returns claimed sample or None if there is nothing to do
+        refreshed = False
+        if self.refresh_time is None or time.time() - self.refresh_time >= self.refresh_seconds:
+            self.refresh()
+            refreshed = True
+        sample = self.claim_scheduled()
+        if sample is None and not refreshed:
+            # Schedule ran dry: Samples may have been added since the last refresh
+            self.refresh()
+            sample = self.claim_scheduled()
+        return sample
+
+
+def renew_sample_claims(owner, lease_seconds=default_claim_lease_seconds):
+    # Heartbeat: Extend leases of all samples claimed by owner
+    samples.update_many({'claim_owner': owner, 'processed': False, 'error': False},
+                        {"$set": {'claim_expires': datetime.utcnow() + timedelta(seconds=lease_seconds)}})
+
+
+def mark_samples_started(sample_ids, owner):
+    # Called by the claiming worker right before inference. Only started samples are charged a processing attempt,
+    # so a crash does not count against samples that were merely prefetched.
+    samples.update_many({'_id': {'$in': sample_ids}, 'claim_owner': owner},
+                        {"$set": {'claim_started': datetime.utcnow()}, "$inc": {'claim_attempts': 1}})
+
+
+def release_sample_claim(sample_id, owner):
+    samples.update_one({'_id': sample_id, 'claim_owner': owner},
+                       {"$set": {'claim_owner': None, 'claim_expires': None, 'claim_started': None}})
+
+
+def release_sample_claims(owner, failed=False):
+    # Release all claims of a worker. Unless the worker failed (crashed or was killed), samples it had started do not
+    # count as processing attempts.
+    if not failed:
+        samples.update_many({'claim_owner': owner, 'processed': False, 'error': False, 'claim_started': {'$ne': None}},
+                            {"$inc": {'claim_attempts': -1}})
+    samples.update_many({'claim_owner': owner},
+                        {"$set": {'claim_owner': None, 'claim_expires': None, 'claim_started': None}})
+
+
+def get_overdue_sample_claim(owner, max_seconds):
+    # Unprocessed sample that owner has started processing longer than max_seconds ago, or None
+    return samples.find_one({'claim_owner': owner, 'processed': False, 'error': False,
+                             'claim_started': {'$lt': datetime.utcnow() - timedelta(seconds=max_seconds)}})
+
+
 def get_processed_samples(dataset_id=None):
     query = {'processed': True, 'error': False}
     if dataset_id is not None:
@@ -230,11 +446,13 @@ def get_error_samples(dataset_id=None):
     return list(samples.find(query))
 
 
-def add_sample(name, filename, size, dataset_id=None):
+def add_sample(name, filename, size, dataset_id=None, content_hash=None):
     sample_record = {'name': name, 'filename': filename, 'dataset_id': dataset_id, 'size': size, 'processed': False,
-                     'annotated': False, 'error': False, 'error_string': None, 'date_added': datetime.now()}
+                     'annotated': False, 'error': False, 'error_string': None, 'date_added': datetime.now(),
+                     'content_hash': content_hash}
     sample_record['_id'] = samples.insert_one(sample_record).inserted_id
     access_dataset(dataset_id)
+    notify_event(event_samples)
     return sample_record
 
 
@@ -242,9 +460,15 @@ def set_sample_data(sample_id, image_size):
     samples.update({'_id': sample_id}, {"$set": {'size': image_size}}, upsert=False)
 
 
+def set_sample_content_hash(sample_id, content_hash):
+    samples.update_one({'_id': sample_id}, {"$set": {'content_hash': content_hash}}, upsert=False)
+
+
 def set_sample_error(sample_id, error_string):
+    # Also releases the sample claim, so a sample reset after an error is claimed again
     print 'Sample %s error: %s' % (str(sample_id), error_string)
-    samples.update({'_id': sample_id}, {"$set": {'error': True, 'error_string': error_string}}, upsert=False)
+    samples.update({'_id': sample_id}, {"$set": {'error': True, 'error_string': error_string, 'claim_owner': None,
+                                                 'claim_expires': None, 'claim_started': None}}, upsert=False)
 
 
 def get_sample_by_id(sample_id):
@@ -270,6 +494,8 @@ def delete_sample(sample_id, delete_files=False, do_access_dataset=True):
                 print 'Deleted', fn
             except OSError:
                 print 'Error deleting', fn
+        # Heatmaps are gone, so the results cannot be reused for identical images any more
+        evict_cached_machine_annotations(sample_id)
     # Mark dataset as accessed
     if do_access_dataset:
         access_dataset(sample['dataset_id'])
@@ -296,8 +522,25 @@ def fix_sample_date_added():
 
 
 # Set image quality measures
-def set_image_measures(sample_id, image_measures):
-    samples.update({'_id': sample_id}, {"$set": image_measures}, upsert=False)
+def set_image_measures(sample_id, image_measures, error_string=None):
+    sample_update = dict(image_measures)
+    sample_update.update({'imq_computed': True, 'imq_error': error_string,
+                          'imq_claim_owner': None, 'imq_claim_expires': None})
+    samples.update({'_id': sample_id}, {"$set": sample_update}, upsert=False)
+
+
+def claim_samples_without_image_measures(owner, count, lease_seconds=default_claim_lease_seconds):
+    # Reserve up to count samples whose image quality measures still need to be computed (oldest first)
+    now = datetime.utcnow()
+    query = {'imq_entropy': {'$exists': False}, 'imq_computed': {'$ne': True},
+             '$or': [{'imq_claim_owner': None}, {'imq_claim_expires': {'$lt': now}}]}
+    candidate_ids = [r['_id'] for r in samples.find(query, {'_id': True}).sort('_id', pymongo.ASCENDING).limit(count)]
+    if not candidate_ids:
+        return []
+    query['_id'] = {'$in': candidate_ids}
+    samples.update_many(query, {"$set": {'imq_claim_owner': owner,
+                                         'imq_claim_expires': now + timedelta(seconds=lease_seconds)}})
+    return list(samples.find({'_id': {'$in': candidate_ids}, 'imq_claim_owner': owner}))
 
 
 # Sample queue for non-primary models and image validation runs #
@@ -306,6 +549,9 @@ sample_queue = epidermal_db['sample_queue']
 # 'sample_id' (id): Link into samples collection
 # 'model_id' (id): Link into model collection
 # 'validation_model_id' (id): Link into model collection for validation set queue items
+# 'claim_owner' (str): ID of the worker currently processing the queue item
+# 'claim_id' (id): Identifies the batch of queue items claimed together
+# 'claim_expires' (datetime): UTC time when the claim lease expires and other workers may take over the item
 
 
 def get_queued_samples(model_id=None):
@@ -315,14 +561,50 @@ def get_queued_samples(model_id=None):
     return sample_queue.find(query)
 
 
+def get_claimable_queue_query(model_id):
+    return {'model_id': model_id, '$or': [{'claim_owner': None}, {'claim_expires': {'$lt': datetime.utcnow()}}]}
+
+
+def has_queued_samples(model_id):
+    # Cheap existence check for unclaimed queue items of a model
+    return sample_queue.find_one(get_claimable_queue_query(model_id), {'_id': True}) is not None
+
+
+def claim_queued_samples(model_id, owner, count, lease_seconds=default_claim_lease_seconds):
+    # Reserve the next (up to) count unclaimed queue items of a model in queue order and return them.
+    # Items are claimed atomically one by one, so items taken concurrently by another worker are skipped.
+    # Claimed items should be removed via unqueue_sample once done; they become available again if the claim expires.
+    query = get_claimable_queue_query(model_id)
+    candidate_ids = [r['_id'] for r in sample_queue.find(query, {'_id': True}).sort('_id', pymongo.ASCENDING)
+                     .limit(count)]
+    if not candidate_ids:
+        return []
+    claim_id = ObjectId()
+    query['_id'] = {'$in': candidate_ids}
+    sample_queue.update_many(query, {"$set": {'claim_owner': owner, 'claim_id': claim_id,
+                                              'claim_expires': datetime.utcnow() + timedelta(seconds=lease_seconds)}})
+    return list(sample_queue.find({'claim_id': claim_id}).sort('_id', pymongo.ASCENDING))
+
+
+def renew_queue_claims(owner, lease_seconds=default_claim_lease_seconds):
+    sample_queue.update_many({'claim_owner': owner},
+                             {"$set": {'claim_expires': datetime.utcnow() + timedelta(seconds=lease_seconds)}})
+
+
+def release_queue_claims(owner):
+    sample_queue.update_many({'claim_owner': owner}, {"$set": {'claim_owner': None, 'claim_expires': None}})
+
+
 def queue_sample(sample_id, model_id):
     rec = {'sample_id': sample_id, 'model_id': model_id}
     sample_queue.update(rec, rec, upsert=True)
+    notify_event(event_queue)
 
 
 def queue_validation(train_model_id, validation_model_id):
     rec = {'validation_model_id': validation_model_id, 'model_id': train_model_id}
     sample_queue.update(rec, rec, upsert=True)
+    notify_event(event_queue)
 
 
 def unqueue_sample(queue_item_id):
@@ -429,6 +711,10 @@ machine_annotations = epidermal_db['machine_annotations']
 # 'heatmap_image_filename' (str): Filename of heatmap image data
 # 'positions' (array[n] of array[2]): [x,y] positions of detected stomata [px]
 # 'margin': Stomata detection margin [px]
+# 'scale' (float): Image scale the CNN was run at
+# 'content_hash' (str): Content hash of the processed image, set while the heatmap files can be reused
+# 'image_zoom_values' (list or None): Scales requested for processing
+# 'threshold_prob' (float): Detection threshold (fc8 units) the positions were counted at
 
 
 def get_machine_annotations(sample_id, model_id=None):
@@ -459,18 +745,21 @@ def remove_machine_annotations_for_dataset(dataset_id):
                          'machine_position_count': None,
                          'machine_hopkins': None,
                          'error': False,
-                         'error_string': None}
+                         'error_string': None,
+                         'claim_attempts': 0}
         samples.update_one({'_id': sample['_id']}, {"$set": sample_update}, upsert=False)
     access_dataset(dataset_id)
+    notify_event(event_samples)
     return c
 
 
 def add_machine_annotation(sample_id, model_id, heatmap_filename, heatmap_image_filename, positions, margin,
-                           is_primary_model, scale=1.0):
+                           is_primary_model, scale=1.0, content_hash=None, image_zoom_values=None, threshold_prob=None):
     annotation_query = {'sample_id': sample_id, 'model_id': model_id}
     annotation_record = {'sample_id': sample_id, 'model_id': model_id, 'heatmap_filename': heatmap_filename,
                          'heatmap_image_filename': heatmap_image_filename, 'positions': positions, 'margin': margin,
-                         'scale': scale}
+                         'scale': scale, 'content_hash': content_hash, 'image_zoom_values': image_zoom_values,
+                         'threshold_prob': threshold_prob}
     machine_annotations.update(annotation_query, annotation_record, upsert=True)
     annotation_record['_id'] = machine_annotations.find_one(annotation_query)['_id']
     if is_primary_model:
@@ -478,20 +767,95 @@ def add_machine_annotation(sample_id, model_id, heatmap_filename, heatmap_image_
     return annotation_record
 
 
-def set_primary_machine_annotation(sample_id, positions):
+def ensure_machine_annotation_indexes():
+    machine_annotations.create_index([('content_hash', pymongo.ASCENDING), ('model_id', pymongo.ASCENDING)])
+
+
+def find_cached_machine_annotations(content_hash, model_id, image_zoom_values, threshold_prob):
+    # Annotations of the model on identical image content with the same processing settings
+    return machine_annotations.find({'content_hash': content_hash, 'model_id': model_id,
+                                     'image_zoom_values': image_zoom_values, 'threshold_prob': threshold_prob})
+
+
+def evict_cached_machine_annotation(machine_annotation_id):
+    machine_annotations.update_one({'_id': machine_annotation_id}, {"$set": {'content_hash': None}}, upsert=False)
+
+
+def evict_cached_machine_annotations(sample_id):
+    machine_annotations.update_many({'sample_id': sample_id}, {"$set": {'content_hash': None}}, upsert=False)
+
+
+def get_primary_machine_annotation_update(positions):
+    # Sample fields derived from the primary model's annotation. Finished or reset samples start over with their
+    # failed claim attempts.
     if positions is None:
-        sample_update = {'processed': False,
-                         'machine_position_count': None,
-                         'machine_hopkins': None,
-                         'error': False,
-                         'error_string': None}
-    else:
-        sample_update = {'processed': True,
-                         'machine_position_count': len(positions),
-                         'machine_hopkins': hopkins(np.array(positions)),
-                         'error': False,
-                         'error_string': None}
-    samples.update({'_id': sample_id}, {"$set": sample_update}, upsert=False)
+        return {'processed': False,
+                'machine_position_count': None,
+                'machine_hopkins': None,
+                'error': False,
+                'error_string': None,
+                'claim_attempts': 0}
+    return {'processed': True,
+            'machine_position_count': len(positions),
+            'machine_hopkins': hopkins(np.array(positions)),
+            'error': False,
+            'error_string': None,
+            'claim_attempts': 0}
+
+
+def set_primary_machine_annotation(sample_id, positions):
+    samples.update({'_id': sample_id}, {"$set": get_primary_machine_annotation_update(positions)}, upsert=False)
+
+
+class ResultWriter:
+    # Collects the final machine annotation and sample state of processed samples in memory and writes them with one
+    # bulk_write per collection once batch_size samples are pending (or on flush). Thread safe.
+    # If a write fails, all samples with a sample update in that flush are set to error (releasing their claims).
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.annotation_requests = []
+        self.sample_requests = []
+        self.sample_ids = []
+
+    def add_machine_annotation(self, sample_id, model_id, heatmap_filename, heatmap_image_filename, positions, margin,
+                               is_primary_model, scale=1.0, content_hash=None, image_zoom_values=None,
+                               threshold_prob=None, release_claim=False):
+        # Same records as add_machine_annotation. Optionally releases the sample claim in the same write.
+        annotation_record = {'sample_id': sample_id, 'model_id': model_id, 'heatmap_filename': heatmap_filename,
+                             'heatmap_image_filename': heatmap_image_filename, 'positions': positions,
+                             'margin': margin, 'scale': scale, 'content_hash': content_hash,
+                             'image_zoom_values': image_zoom_values, 'threshold_prob': threshold_prob}
+        sample_update = get_primary_machine_annotation_update(positions) if is_primary_model else {}
+        if release_claim:
+            sample_update.update({'claim_owner': None, 'claim_expires': None, 'claim_started': None})
+        with self.lock:
+            self.annotation_requests.append(pymongo.ReplaceOne({'sample_id': sample_id, 'model_id': model_id},
+                                                               annotation_record, upsert=True))
+            if sample_update:
+                self.sample_requests.append(pymongo.UpdateOne({'_id': sample_id}, {"$set": sample_update}))
+                self.sample_ids.append(sample_id)
+            do_flush = len(self.annotation_requests) >= self.batch_size
+        if do_flush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            annotation_requests, self.annotation_requests = self.annotation_requests, []
+            sample_requests, self.sample_requests = self.sample_requests, []
+            sample_ids, self.sample_ids = self.sample_ids, []
+        try:
+            # Annotations first, so a processed sample always has its annotation
+            if annotation_requests:
+                machine_annotations.bulk_write(annotation_requests, ordered=False)
+            if sample_requests:
+                samples.bulk_write(sample_requests, ordered=False)
+        except:
+            error_string = traceback.format_exc()
+            print 'Writing results of %d samples failed.' % len(annotation_requests)
+            for sample_id in sample_ids:
+                set_sample_error(sample_id, "Writing results failed:\n" + error_string)
 
 
 def update_machine_annotation_positions(sample_id, machine_annotation_id, positions, is_primary_model):
@@ -505,22 +869,62 @@ def update_machine_annotation_positions(sample_id, machine_annotation_id, positi
         samples.update({'_id': sample_id}, {"$set": {'machine_position_count': len(positions)}}, upsert=False)
 
 
+def queue_recount_for_dataset(dataset_id):
+    # Recount processed samples on their stored heatmaps. Returns number of queued samples.
+    # A new recount ID is set each time, so a sample queued again while being recounted is recounted again.
+    r = samples.update_many({'dataset_id': dataset_id, 'processed': True, 'error': False},
+                            {"$set": {'recount': ObjectId()}}, upsert=False)
+    access_dataset(dataset_id)
+    notify_event(event_samples)
+    return r.modified_count
+
+
+def claim_recount_samples(owner, count, lease_seconds=default_claim_lease_seconds):
+    now = datetime.utcnow()
+    query = {'recount': {'$ne': None}, '$or': [{'claim_owner': None}, {'claim_expires': {'$lt': now}}]}
+    candidate_ids = [r['_id'] for r in samples.find(query, {'_id': True}).sort('_id', pymongo.ASCENDING).limit(count)]
+    if not candidate_ids:
+        return []
+    query['_id'] = {'$in': candidate_ids}
+    samples.update_many(query, {"$set": {'claim_owner': owner,
+                                         'claim_expires': now + timedelta(seconds=lease_seconds)}})
+    return list(samples.find({'_id': {'$in': candidate_ids}, 'claim_owner': owner}))
+
+
+def finish_recount_sample(sample, machine_annotation_id, positions, threshold_prob):
+    machine_annotations.update_one({'_id': machine_annotation_id},
+                                   {"$set": {'positions': positions, 'threshold_prob': threshold_prob}}, upsert=False)
+    set_primary_machine_annotation(sample['_id'], positions)
+    samples.update_one({'_id': sample['_id'], 'recount': sample['recount']}, {"$set": {'recount': None}}, upsert=False)
+    samples.update_one({'_id': sample['_id']}, {"$set": {'claim_owner': None, 'claim_expires': None}}, upsert=False)
+
+
+def reset_recount_sample(sample):
+    # Sample cannot be recounted from its heatmap: Process it again from the image
+    set_primary_machine_annotation(sample['_id'], None)
+    samples.update_one({'_id': sample['_id']}, {"$set": {'recount': None, 'claim_owner': None,
+                                                         'claim_expires': None}}, upsert=False)
+    notify_event(event_samples)
+
+
 def delete_all_machine_annotations():
     r = machine_annotations.delete_many({})
     sample_update = {'processed': False,
                      'machine_position_count': None,
                      'machine_hopkins': None,
                      'error': False,
-                     'error_string': None}
+                     'error_string': None,
+                     'claim_attempts': 0}
     samples.update_many({}, {"$set": sample_update}, upsert=False)
+    notify_event(event_samples)
     print 'Deleted %d machine annotations.' % r.deleted_count
     return r.deleted_count > 0
 
 
-# Update the machine position count and hopkins field based on primary model results
-def fix_primary_machine_annotations():
+# Update the machine position count and hopkins field based on primary model results (of all or the given samples)
+def fix_primary_machine_annotations(sample_ids=None):
     model_id = get_primary_model()['_id']
-    for s in samples.find():
+    for s in samples.find({} if sample_ids is None else {'_id': {'$in': sample_ids}}):
         machine = get_machine_annotations(s['_id'], model_id=model_id)
         if not machine:
             set_primary_machine_annotation(s['_id'], None)
@@ -542,6 +946,8 @@ def get_user_by_id(user_id):
 models = epidermal_db['models']
 # 'name' (str): Model name
 # 'margin' (int): Margin at each side that the model does not predict [px]
+# 'net_margin' (int): Network input margin without output as determined on first load [px]
+# 'net_stride' (int): Network output stride as determined on first load [px]
 # 'date_added' (datetime): When the model training was issued
 # 'status' (str): 'scheduled', 'training' or 'trained'
 model_status_scheduled = 'scheduled'
@@ -586,6 +992,7 @@ def add_model(model_name, margin, sample_limit=None, train_tag='train', schedule
                     'scheduled_primary': scheduled_primary,
                     'dataset_only': dataset_only}
     model_record['_id'] = models.insert_one(model_record).inserted_id
+    notify_event(event_models)
     return model_record
 
 
@@ -598,7 +1005,7 @@ def delete_model(model_id):
 def set_model_parameters(model_id, new_settings):
     result = models.update_one({'_id': model_id}, {"$set": new_settings}, upsert=False)
     print 'result', result
-    if not result.modified_count:
+    if not result.matched_count:
         raise RuntimeError('set_model_parameters: Model ID %s not found.' % str(model_id))
 
 
@@ -630,12 +1037,14 @@ def set_primary_model(model_id):
     if previous_primary is not None:
         models.update_one({'_id': previous_primary['_id']}, {"$set": {'primary': False}}, upsert=False)
     fix_primary_machine_annotations()
+    notify_event(event_models)
 
 
 def set_model_status(model_id, new_status):
     assert new_status in {model_status_scheduled, model_status_training, model_status_trained, model_status_failed,
                           model_status_dataset}
     models.update_one({'_id': model_id}, {"$set": {'status': new_status}}, upsert=False)
+    notify_event(event_models)
 
 
 
@@ -644,6 +1053,7 @@ def set_model_status(model_id, new_status):
 status = epidermal_db['status']
 # 'component' (str): Component name for status string
 # 'staus' (str): Status string
+# 'progress' (dict): Structured progress of the component's current task (see progress.ProgressReporter)
 
 
 def get_status(component):
@@ -653,8 +1063,84 @@ def get_status(component):
     return rec['status']
 
 
-def set_status(component, status_string):
-    status.update({'component': component}, {"$set": {'component': component, 'status': status_string}}, upsert=True)
+def get_status_record(component):
+    return status.find_one({'component': component})
+
+
+def set_status(component, status_string, progress=None):
+    # progress (dict): Optional structured progress (done, total, rate [images/s], eta_seconds, date)
+    status.update({'component': component}, {"$set": {'component': component, 'status': status_string,
+                                                      'progress': progress}}, upsert=True)
+
+
+# Events #
+##########
+# Capped collection through which the web service and workers wake up waiting workers
+event_collection_name = 'events'
+# 'event' (str): Event name (event_samples, event_queue or event_models)
+# 'date' (datetime): When the event was signalled (UTC)
+event_samples = 'samples'  # Samples were added or need to be processed again
+event_queue = 'queue'  # Samples were queued for secondary models
+event_models = 'models'  # Models were scheduled, trained or the primary model changed
+# Waiting workers re-check the database at least this often [s], in case an event was missed
+event_poll_seconds = 10
+
+
+events_collection_ready = False
+
+
+def get_events_collection():
+    global events_collection_ready
+    if not events_collection_ready and event_collection_name not in epidermal_db.collection_names():
+        try:
+            epidermal_db.create_collection(event_collection_name, capped=True, size=1024 * 1024, max=1000)
+            # Tailable cursors die immediately on empty collections
+            epidermal_db[event_collection_name].insert_one({'event': 'init', 'date': datetime.utcnow()})
+        except CollectionInvalid:
+            pass  # Created concurrently
+    events_collection_ready = True
+    return epidermal_db[event_collection_name]
+
+
+def notify_event(event_name):
+    get_events_collection().insert_one({'event': event_name, 'date': datetime.utcnow()})
+
+
+class EventListener:
+    # Waits for events via a tailable cursor on the capped events collection. Only events signalled after the
+    # listener was created are reported.
+
+    def __init__(self, event_names):
+        self.event_names = set(event_names)
+        self.events = get_events_collection()
+        last_event = list(self.events.find().sort('$natural', -1).limit(1))
+        self.last_event_id = last_event[0]['_id'] if last_event else None
+        self.cursor = None
+
+    def open_cursor(self):
+        query = {} if self.last_event_id is None else {'_id': {'$gt': self.last_event_id}}
+        self.cursor = self.events.find(query, cursor_type=pymongo.CursorType.TAILABLE_AWAIT).max_await_time_ms(1000)
+
+    def wait(self, timeout):
+        # Block until one of the events is signalled (returns True) or timeout [s] has passed (returns False)
+        deadline = time.time() + timeout
+        try:
+            while time.time() < deadline:
+                if self.cursor is None or not self.cursor.alive:
+                    self.open_cursor()
+                for event in self.cursor:
+                    self.last_event_id = event['_id']
+                    if event['event'] in self.event_names:
+                        return True
+                    if time.time() >= deadline:
+                        break
+                if not self.cursor.alive:
+                    time.sleep(min(1.0, max(0.0, deadline - time.time())))
+        except pymongo.errors.PyMongoError:
+            # Fall back to polling
+            self.cursor = None
+            time.sleep(max(0.0, deadline - time.time()))
+        return False
 
 
 # Helpers
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Image file decoding for CNN processing and heatmap rendering
+
+import os
+import hashlib
+import numpy as np
+import cv2
+from PIL import Image
+
+
+# Formats that can be decoded at reduced resolution (DCT scaling)
+jpeg_extensions = ('.jpg', '.jpeg')
+
+
+def get_file_hash(filename, chunk_size=1024 * 1024):
+    # SHA-1 of the file content, identifying re-uploads of identical images
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_image_size(image_filename):
+    # Image size (width, height) read from the file header without decoding pixel data
+    return Image.open(image_filename).size
+
+
+def load_jpeg_reduced(image_filename, scale, region):
+    # Let libjpeg decode at the smallest of 1/1, 1/2, 1/4 or 1/8 resolution that is at least the requested scale.
+    # Returns the (region of the) decoded image as uint8 BGR and the actual scale it was decoded at.
+    im = Image.open(image_filename)
+    full_size = im.size
+    im.draft('RGB', (int(full_size[0] * scale), int(full_size[1] * scale)))
+    decode_scale = float(im.size[0]) / full_size[0]
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    if region is not None:
+        im = im.crop(tuple(int(round(v * decode_scale)) for v in region))
+    return cv2.cvtColor(np.asarray(im), cv2.COLOR_RGB2BGR), decode_scale
+
+
+def load_image(image_filename, scale=1.0, region=None):
+    # Decode image straight to uint8 BGR (HxWx3), which is what the network input expects.
+    # region (x0, y0, x1, y1 in full resolution pixels) limits the output to part of the image. If scale is below
+    # one, JPEGs are decoded at reduced resolution and only the remaining factor is resampled.
+    # EXIF orientation is ignored to match the image size stored for the sample.
+    if scale < 1.0 and os.path.splitext(image_filename)[1].lower() in jpeg_extensions:
+        image, decode_scale = load_jpeg_reduced(image_filename, scale, region)
+    else:
+        image = cv2.imread(image_filename, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is None:
+            raise RuntimeError('Could not load image "%s".' % image_filename)
+        decode_scale = 1.0
+        if region is not None:
+            image = image[region[1]:region[3], region[0]:region[2], :].copy()
+    if scale != decode_scale:
+        if region is None:
+            full_size = get_image_size(image_filename)
+        else:
+            full_size = (region[2] - region[0], region[3] - region[1])
+        target_size = (int(round(full_size[0] * scale)), int(round(full_size[1] * scale)))
+        interpolation = cv2.INTER_AREA if scale < decode_scale else cv2.INTER_LINEAR
+        image = cv2.resize(image, target_size, interpolation=interpolation)
+    return image
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Image resampling to processing scales with a bounded cache of pyramid levels
+
+import os
+import threading
+from collections import OrderedDict
+import cv2
+
+from image_loader import load_image
+
+
+# Maximum total size of cached pyramid levels
+max_pyramid_cache_bytes = 512 * 1024 * 1024
+
+
+def resize_image(image, scale):
+    # Fast uint8 resampling: Area averaging for downscaling and bilinear interpolation for upscaling
+    if scale == 1.0:
+        return image
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=interpolation)
+
+
+class ImagePyramidCache:
+    # LRU cache of image levels keyed by (image key, scale), bounded by total size in bytes
+
+    def __init__(self, max_bytes=max_pyramid_cache_bytes):
+        self.max_bytes = max_bytes
+        self.levels = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, scale):
+        with self.lock:
+            level = self.levels.pop((key, scale), None)
+            if level is not None:
+                self.levels[(key, scale)] = level
+            return level
+
+    def put(self, key, scale, level):
+        with self.lock:
+            previous_level = self.levels.pop((key, scale), None)
+            if previous_level is not None:
+                self.total_bytes -= previous_level.nbytes
+            if level.nbytes > self.max_bytes:
+                return
+            self.levels[(key, scale)] = level
+            self.total_bytes += level.nbytes
+            while self.total_bytes > self.max_bytes:
+                _, evicted_level = self.levels.popitem(last=False)
+                self.total_bytes -= evicted_level.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.levels.clear()
+            self.total_bytes = 0
+
+
+pyramid_cache = ImagePyramidCache()
+
+
+def get_image_level(image_filename, scale=1.0):
+    # Get image at given scale (uint8 BGR), shared between inference, heatmap rendering and all models.
+    # Levels are shared, so they are returned read-only.
+    key = (image_filename, os.path.getmtime(image_filename))
+    level = pyramid_cache.get(key, scale)
+    if level is None:
+        if scale < 1.0 and pyramid_cache.get(key, 1.0) is None:
+            # Full resolution is not needed (yet): Decode at reduced resolution directly
+            level = load_image(image_filename, scale=scale)
+        elif scale == 1.0:
+            level = load_image(image_filename)
+        else:
+            level = resize_image(get_image_level(image_filename, 1.0), scale)
+        level.flags.writeable = False
+        pyramid_cache.put(key, scale, level)
+    return level
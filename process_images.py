@@ -6,7 +6,9 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 import csv
 
-from apply_fcn_caffe import init_model, process_image_file, plot_heatmap
+from apply_fcn_caffe import init_model, process_image_file, render_heatmap, heatmap_to_uint8
+from image_pyramid import get_image_level
+from cnn_backend import backend_names
 from stoma_counter import compute_stomata_positions_on_prob, default_prob_threshold, default_prob_area_threshold
 from image_measures import get_image_measures, image_measures
 
@@ -21,7 +23,9 @@ def load_net(args):
                       worker_gpu_index=args.gpu_index,
                       net_output_name=args.cnn_top_layer_name,
                       input_size=(256, 256),  # input will be reshaped on first image
-                      network_name=os.path.basename(args.weights_filename))
+                      network_name=os.path.basename(args.weights_filename),
+                      backend=args.backend,
+                      threads=args.threads)
 
 
 # Count stomata on one image, output heatmap file and and return results record
@@ -62,7 +66,7 @@ def process_image(net, image_path, args):
     if has_heatmap:
         if args.verbose:
             print 'Plotting heatmap...'
-        heatmap_image = plot_heatmap(image_path, heatmap_path, None)
+        heatmap_image = heatmap_to_uint8(render_heatmap(get_image_level(image_path), data['probs'], data['scale']))
 
     # Count stomata
     if args.verbose:
@@ -128,6 +132,16 @@ if __name__ == '__main__':
                         type=int,
                         default=0,
                         help='Index of GPU to initialize caffe on. If -1, no GPU is used.')
+    parser.add_argument('--backend',
+                        type=str,
+                        default='caffe',
+                        choices=backend_names,
+                        help='Inference backend. opencv runs on the CPU through the OpenCV DNN module and does not '
+                             'require caffe.')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=0,
+                        help='Number of CPU threads for the opencv backend. 0 uses the OpenCV default.')
     parser.add_argument('--cnn-top-layer-name',
                         type=str,
                         default='fc8stoma-conv',
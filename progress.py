@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Buffered worker progress reporting with throughput and ETA
+
+import time
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+import db
+
+
+# Minimum time between writes of buffered progress to the database [s]
+default_flush_seconds = 2.0
+# Throughput is measured over this window of recently finished items [s]
+rate_window_seconds = 60.0
+
+
+def format_duration(seconds):
+    return str(timedelta(seconds=int(round(seconds))))
+
+
+def format_progress(status_string, progress):
+    # Human readable status line from a structured progress record
+    if not progress:
+        return status_string
+    parts = []
+    if progress.get('total'):
+        parts.append('%d/%d' % (progress['done'], progress['total']))
+    if progress.get('rate'):
+        parts.append('%.1f images/s' % progress['rate'])
+    if progress.get('eta_seconds') is not None:
+        parts.append('ETA %s' % format_duration(progress['eta_seconds']))
+    if not parts:
+        return status_string
+    return '%s (%s)' % (status_string, ', '.join(parts))
+
+
+def get_status_text(component):
+    rec = db.get_status_record(component)
+    if rec is None:
+        return 'Unknown'
+    return format_progress(rec['status'], rec.get('progress'))
+
+
+def get_dataset_eta_seconds(dataset_info, pending_count):
+    # Expected time until all pending samples of the dataset are processed, or None if no worker is on it
+    rate = db.get_dataset_processing_rate(dataset_info, max_age_seconds=rate_window_seconds)
+    if not pending_count or not rate:
+        return None
+    return pending_count / rate
+
+
+class ProgressReporter:
+    # Collects status and progress of a worker in memory. Progress is written to the status collection (and
+    # throughput per dataset to the datasets) at most every flush_seconds, instead of once per processed item.
+    # Thread safe, so post-processing threads can report finished items.
+
+    def __init__(self, component, worker_id, flush_seconds=default_flush_seconds):
+        self.component = component
+        self.worker_key = worker_id.replace('.', '_')
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.status_string = 'Unknown'
+        self.done = 0
+        self.total = None
+        self.finish_times = deque()
+        self.dataset_finish_times = {}
+        self.last_flush_time = 0.0
+
+    def set_status(self, status_string, total=None, force=False):
+        # Set status text. Passing a total starts counting a new task.
+        with self.lock:
+            self.status_string = status_string
+            if total is not None:
+                self.done = 0
+                self.total = total
+        self.flush(force=force)
+
+    def add_done(self, dataset_id=None, count=1):
+        now = time.time()
+        with self.lock:
+            self.done += count
+            for i in xrange(count):
+                self.finish_times.append(now)
+                if dataset_id is not None:
+                    self.dataset_finish_times.setdefault(dataset_id, deque()).append(now)
+        self.flush()
+
+    def get_rate(self, finish_times, now):
+        # Items per second over the window. Call with lock held.
+        while finish_times and finish_times[0] < now - rate_window_seconds:
+            finish_times.popleft()
+        if len(finish_times) < 2:
+            return None
+        return len(finish_times) / max(now - finish_times[0], 1.0)
+
+    def flush(self, force=False):
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_flush_time < self.flush_seconds:
+                return
+            self.last_flush_time = now
+            status_string = self.status_string
+            rate = self.get_rate(self.finish_times, now)
+            progress = {'done': self.done, 'total': self.total, 'rate': rate, 'eta_seconds': None,
+                        'date': datetime.utcnow()}
+            if rate and self.total:
+                progress['eta_seconds'] = max(self.total - self.done, 0) / rate
+            dataset_rates = {}
+            for dataset_id, finish_times in self.dataset_finish_times.items():
+                dataset_rates[dataset_id] = self.get_rate(finish_times, now) or 0.0
+                if not finish_times:
+                    # Idle on this dataset: Remove the rate entry of this worker
+                    del self.dataset_finish_times[dataset_id]
+                    dataset_rates[dataset_id] = None
+        db.set_status(self.component, status_string, progress=progress)
+        for dataset_id, dataset_rate in dataset_rates.iteritems():
+            db.set_dataset_processing_rate(dataset_id, self.worker_key, dataset_rate)
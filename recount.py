@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Recount stomata from stored heatmaps (e.g. after a threshold change) without running the CNN again
+
+import os
+import traceback
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import db
+from config import config
+from apply_fcn_caffe import render_heatmap, heatmap_to_uint8, prob_to_fc8
+from image_loader import load_image
+from stoma_counter_peaks import compute_stomata_positions_on_prob, default_prob_threshold
+
+
+def recount_sample(job):
+    # Runs in pool processes (no DB access): Count on stored probabilities and re-render the overlay image.
+    # Returns positions and error string.
+    try:
+        data = np.load(job['heatmap_filename_full'])
+        probs, scale = data['probs'], float(data['scale'])
+        heatmap_image = heatmap_to_uint8(render_heatmap(load_image(job['image_filename_full']), probs, scale))
+        positions = compute_stomata_positions_on_prob(probs=probs,
+                                                      scale=scale,
+                                                      margin=job['margin'],
+                                                      sample_size=job['sample_size'],
+                                                      heatmap_image=heatmap_image,
+                                                      plot=False,
+                                                      prob_threshold=job['threshold_prob'],
+                                                      verbose=False)
+        plt.imsave(job['heatmap_image_filename_full'], heatmap_image)
+        return positions, None
+    except:
+        return None, traceback.format_exc()
+
+
+def get_dataset_threshold(dataset_id):
+    threshold_prob_val = (db.get_dataset_by_id(dataset_id) or {}).get('threshold_prob')
+    return prob_to_fc8(threshold_prob_val) if threshold_prob_val else default_prob_threshold
+
+
+def get_recount_job(sample, model_id, dataset_thresholds):
+    # Returns recount job for a sample or None if there is no stored heatmap to count on
+    annotations = db.get_machine_annotations(sample['_id'], model_id)
+    if not annotations or not annotations[0].get('heatmap_filename'):
+        return None
+    annotation = annotations[0]
+    heatmap_filename_full = os.path.join(config.get_server_heatmap_path(), annotation['heatmap_filename'])
+    if not os.path.isfile(heatmap_filename_full):
+        return None
+    if sample['dataset_id'] not in dataset_thresholds:
+        dataset_thresholds[sample['dataset_id']] = get_dataset_threshold(sample['dataset_id'])
+    return {'machine_annotation_id': annotation['_id'],
+            'image_filename_full': os.path.join(config.get_server_image_path(), sample['filename']),
+            'heatmap_filename_full': heatmap_filename_full,
+            'heatmap_image_filename_full': os.path.join(config.get_server_heatmap_path(),
+                                                        annotation['heatmap_image_filename']),
+            'margin': annotation['margin'],
+            'sample_size': sample['size'],
+            'threshold_prob': dataset_thresholds[sample['dataset_id']]}
+
+
+def process_recounts(pool, owner, model_id, batch_size):
+    # Recount all samples queued for recounting with the primary model. Samples that cannot be recounted from their
+    # stored heatmap are processed again by the CNN. Returns number of handled samples.
+    n = 0
+    dataset_thresholds = {}
+    while True:
+        sample_batch = db.claim_recount_samples(owner, batch_size)
+        if not sample_batch:
+            return n
+        jobs = [get_recount_job(sample, model_id, dataset_thresholds) for sample in sample_batch]
+        for sample, job in zip(sample_batch, jobs):
+            if job is None:
+                db.reset_recount_sample(sample)
+        recount_samples = [(sample, job) for sample, job in zip(sample_batch, jobs) if job is not None]
+        results = pool.map(recount_sample, [job for sample, job in recount_samples])
+        for (sample, job), (positions, error_string) in zip(recount_samples, results):
+            if error_string is None:
+                db.finish_recount_sample(sample, job['machine_annotation_id'], positions, job['threshold_prob'])
+            else:
+                print 'Recount of %s failed. Processing again.\n%s' % (sample['filename'], error_string)
+                db.reset_recount_sample(sample)
+        n += len(sample_batch)
@@ -7,44 +7,50 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from scipy.ndimage.filters import maximum_filter
-from scipy.ndimage.morphology import generate_binary_structure, binary_erosion
+from scipy.ndimage.morphology import generate_binary_structure
 
 
 default_prob_threshold = 2.0
 default_prob_area_threshold = 1.0
+# Radius of stoma markers drawn on heatmap images, in probability map pixels
+peak_marker_radius = 3
+# 8-connected neighborhood for peak detection
+peak_neighborhood = generate_binary_structure(2, 2)
 
 
 def detect_peaks(image):
-    """
-    Takes an image and detect the peaks usingthe local maximum filter.
-    Returns a boolean mask of the peaks (i.e. 1 when
-    the pixel's value is the neighborhood maximum, 0 otherwise)
-    http://stackoverflow.com/questions/3684484/peak-detection-in-a-2d-array
-    """
+    # Boolean mask of local maxima (8-connected neighborhood) among the non-zero pixels of image.
+    # Zero is background, so the maximum filter alone suffices and no separate erosion of the background is needed.
+    # http://stackoverflow.com/questions/3684484/peak-detection-in-a-2d-array
+    return (maximum_filter(image, footprint=peak_neighborhood) == image) & (image != 0)
 
-    # define an 8-connected neighborhood
-    neighborhood = generate_binary_structure(2,2)
 
-    #apply the local maximum filter; all pixel of maximal value
-    #in their neighborhood are set to 1
-    local_max = maximum_filter(image, footprint=neighborhood)==image
-    #local_max is a mask that contains the peaks we are
-    #looking for, but also the background.
-    #In order to isolate the peaks we must remove the background from the mask.
+def find_peaks(probs, prob_threshold=default_prob_threshold):
+    # Local maxima of probs at or above threshold in one vectorized pass.
+    # Returns row indices, column indices and values of the peaks as arrays.
+    probs_threshed = np.where(probs >= prob_threshold, probs, 0.0)
+    peak_indices = np.flatnonzero(detect_peaks(probs_threshed))
+    rows, cols = np.unravel_index(peak_indices, probs.shape)
+    return rows, cols, probs.ravel()[peak_indices]
 
-    #we create the mask of the background
-    background = (image==0)
 
-    #a little technicality: we must erode the background in order to
-    #successfully subtract it form local_max, otherwise a line will
-    #appear along the background border (artifact of the local maximum filter)
-    eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
+def detect_stomata(probs, margin, sample_size, prob_threshold=default_prob_threshold):
+    # Stomata positions in image coordinates (Nx2 int array) and their probabilities (N array) from a probability map
+    zoom = float(sample_size[0] - 2 * margin) / probs.shape[0]
+    rows, cols, values = find_peaks(probs, prob_threshold)
+    positions = (np.stack((rows, cols), axis=1) * zoom + margin + zoom / 2).astype(int)
+    scores = 1.0 / (1.0 + np.exp(-2.0 * values))
+    return positions, scores
 
-    #we obtain the final mask, containing only peaks,
-    #by removing the background from the local_max mask (xor operation)
-    detected_peaks = local_max ^ eroded_background
 
-    return detected_peaks
+def draw_stomata(heatmap_image, positions, scores, zoom):
+    # Mark detected stomata and their probabilities on a uint8 heatmap image (in place)
+    radius_zoomed = int(peak_marker_radius * zoom)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    for pos, score in zip(positions.tolist(), scores.tolist()):
+        pos = tuple(pos)
+        cv2.circle(heatmap_image, center=pos, radius=radius_zoomed, color=(255, 255, 0), thickness=4)
+        cv2.putText(heatmap_image, '%.3f' % score, pos, font, 1.0, (127, 255, 0), 2, cv2.LINE_AA)
 
 
 def compute_stomata_positions_on_prob(probs, scale, margin, sample_size,
@@ -65,22 +71,10 @@ def compute_stomata_positions_on_prob(probs, scale, margin, sample_size,
         heatmap_image2 = heatmap_image
 
     if do_peaks:
-        probs_threshed = probs.copy()
-        probs_threshed[probs < prob_threshold] = 0.0
-        peaks = detect_peaks(probs_threshed)
-        peak_coords = np.nonzero(peaks)
-        for c in zip(peak_coords[0], peak_coords[1]):
-            thresh = probs[c[0], c[1]]
-            thresh_p = np.exp(thresh) / (np.exp(thresh) + np.exp(-thresh))
-            pos = c
-            radius = 3
-            pos_zoomed = tuple(int(x * zoom + margin + zoom / 2) for x in pos)
-            radius_zoomed = int(radius * zoom)
-            positions += [pos_zoomed]
-            if heatmap_image2 is not None:
-                cv2.circle(heatmap_image2, center=pos_zoomed, radius=radius_zoomed, color=(255, 255, 0), thickness=4)
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                cv2.putText(heatmap_image2, '%.3f' % thresh_p, pos_zoomed, font, 1.0, (127, 255, 0), 2, cv2.LINE_AA)
+        peak_positions, peak_scores = detect_stomata(probs, margin, sample_size, prob_threshold)
+        positions += [tuple(pos) for pos in peak_positions.tolist()]
+        if heatmap_image2 is not None:
+            draw_stomata(heatmap_image2, peak_positions, peak_scores, zoom)
 
     if do_contour:
         pthresh = (probs >= prob_threshold).astype(np.uint8).copy()
@@ -104,8 +98,9 @@ def compute_stomata_positions_on_prob(probs, scale, margin, sample_size,
             axarr[0,1].matshow(pthresh)
             axarr[0,2].imshow(heatmap_image.transpose((1, 0, 2)))
         if do_peaks:
+            probs_threshed = np.where(probs >= prob_threshold, probs, 0.0)
             axarr[1,0].matshow(probs_threshed)
-            axarr[1,1].matshow(peaks)
+            axarr[1,1].matshow(detect_peaks(probs_threshed))
             axarr[1, 2].imshow(heatmap_image2.transpose((1, 0, 2)))
         f.suptitle('%d Stomata' % len(positions))
         plt.figure()
@@ -3,7 +3,6 @@
 
 import os
 import sys
-import time
 from config import config
 import subprocess
 from archive2dataset import db2patches, patches2filelist
@@ -113,6 +112,7 @@ def train(model_id):
 def run_daemon():
     set_status('Daemon startup...')
     try:
+        listener = db.EventListener([db.event_models])
         while True:
             scheduled_models = list(db.get_models(details=False, status=db.model_status_scheduled))
             if len(scheduled_models):
@@ -128,7 +128,7 @@ def run_daemon():
                     print 'ERRORED!'
                     print open(log_filename, 'rt').read()
             set_status('Waiting for scheduled models...')
-            time.sleep(1)
+            listener.wait(db.event_poll_seconds)
     finally:
         set_status('offline')
 
@@ -11,6 +11,7 @@ import subprocess
 
 from config import config
 import db
+from progress import get_status_text
 from cleanup_old_datasets import find_old_datasets, delete_datasets
 from webapp_base import pop_last_error, set_error, set_notice
 
@@ -59,6 +60,8 @@ status_ids = (
     ('Count worker', 'worker'),
     ('Validation worker', 'sec_worker'),
     ('Network trainer', 'trainer'),
+    ('Image measure worker', 'imq_worker'),
+    ('Worker supervisor', 'supervisor'),
 )
 
 
@@ -130,7 +133,7 @@ def admin_worker():
             target_name = '!!!'
         enqueued2.append((model_name, target_name, str(item['_id'])))
     enqueued2 = sorted(enqueued2, key=lambda item: item[0])
-    status = [(status_name, db.get_status(status_id)) for status_name, status_id in status_ids]
+    status = [(status_name, get_status_text(status_id)) for status_name, status_id in status_ids]
     return render_template('admin_worker.html', enqueued=enqueued, status=status, enqueued2=enqueued2, error=pop_last_error())
 
 
@@ -11,6 +11,7 @@ from webapp_users import get_current_user_id
 import db
 from stoma_counter_peaks import default_prob_threshold
 from apply_fcn_caffe import prob_to_fc8, fc8_to_prob
+from progress import get_status_text, get_dataset_eta_seconds, format_duration
 
 
 datasets = Blueprint('datasets', __name__, template_folder='templates')
@@ -63,8 +64,8 @@ def dataset_set_threshold(dataset_id_str, new_threshold_str):
         set_notice('Threshold not updated: Values are identical.')
     else:
         db.set_dataset_threshold_prob(dataset_id, new_threshold)
-        count = db.remove_machine_annotations_for_dataset(dataset_id)
-        set_notice('Threshold updated. %d annotations removed.' % count)
+        count = db.queue_recount_for_dataset(dataset_id)
+        set_notice('Threshold updated. %d images queued for recount.' % count)
     return redirect('/dataset/' + dataset_id_str)
 
 
@@ -116,9 +117,12 @@ def dataset_info(dataset_id_str):
         sample['index'] = i
     errored = db.get_error_samples(dataset_id=dataset_id)
     threshold_prob = round(dataset_info.get('threshold_prob') or fc8_to_prob(default_prob_threshold), ndigits=3)
+    eta_seconds = get_dataset_eta_seconds(dataset_info, len(enqueued))
+    eta = None if eta_seconds is None else format_duration(eta_seconds)
     # Get request data
     return render_template("dataset.html", dataset_name=dataset_info['name'], dataset_id=dataset_id_str,
-                           enqueued=enqueued, finished=finished, errored=errored, status=db.get_status('worker'),
+                           enqueued=enqueued, finished=finished, errored=errored,
+                           status=get_status_text('worker'), eta=eta,
                            readonly=db.is_readonly_dataset(dataset_info), error=pop_last_error(),
                            dataset_user=dataset_info.get('user'), image_zoom=dataset_info.get('image_zoom', 'default'),
                            threshold_prob=threshold_prob)
@@ -10,6 +10,7 @@ from zipfile import ZipFile
 from webapp_users import get_current_user_id
 from PIL import Image
 from webapp_base import error_redirect, set_error, set_notice
+from image_loader import get_file_hash
 
 # Upload
 def upload_file(dataset_id, image_zoom=None, threshold_prob=None, allow_reuse=False):
@@ -107,6 +108,7 @@ def add_uploaded_image(dataset_id, full_fn, filename):
         set_error('Could not load image. Invalid / Upload error?')
         return None
     # Add DB entry (after file save to worker can pick it up immediately)
-    entry = db.add_sample(name=filename, filename=os.path.basename(full_fn), size=im.size, dataset_id=dataset_id)
+    entry = db.add_sample(name=filename, filename=os.path.basename(full_fn), size=im.size, dataset_id=dataset_id,
+                          content_hash=get_file_hash(full_fn))
     # Return added entry
     return entry
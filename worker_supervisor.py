@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# Supervisor running a pool of apply worker processes. The number of workers follows the number of unprocessed
+# samples, each worker is limited to its share of CPU threads, and crashed workers are restarted with backoff.
+# Workers stuck on a sample or exceeding the memory limit are killed.
+
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+from multiprocessing import cpu_count
+
+import db
+from config import config, add_config_option
+
+
+# Environment variables limiting the thread pools of numerical libraries in each worker
+thread_env_names = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+# Unprocessed samples per running worker before another worker is started
+samples_per_worker = 20
+# Workers are only stopped after the backlog has been low for this long [s]
+scale_down_delay_seconds = 60
+# Restart delay after crashes doubles up to this maximum [s]
+max_restart_backoff_seconds = 300
+# Workers running at least this long [s] are considered healthy and reset the backoff
+healthy_run_seconds = 60
+# Hostname part of the worker IDs the children use in sample claims
+hostname = socket.gethostname()
+# Workers not exiting within this time after SIGTERM are killed [s]
+stop_timeout_seconds = 30
+# Exit code of apply_worker.py requesting a restart
+EXITCODE_RESTART = 55
+
+
+def get_process_rss_mb(pid):
+    # Resident memory of a process [MB] (Linux only; None if unavailable)
+    try:
+        for line in open('/proc/%d/status' % pid, 'rt'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+def get_worker_command(threads):
+    cmdline = [sys.executable, os.path.join(config.src_path, 'apply_worker.py'), '--run', '--threads', str(threads)]
+    try:
+        cmdline += ['--config', sys.argv[sys.argv.index('--config') + 1]]
+    except ValueError:
+        pass
+    return cmdline
+
+
+class WorkerSlot:
+    # One supervised worker process and its restart state
+
+    def __init__(self, index, threads):
+        self.index = index
+        self.threads = threads
+        self.process = None
+        self.start_time = None
+        self.failures = 0
+        self.restart_time = 0.0
+
+    def start(self):
+        env = dict(os.environ)
+        for name in thread_env_names:
+            env[name] = str(self.threads)
+        self.process = subprocess.Popen(get_worker_command(self.threads), env=env)
+        self.start_time = time.time()
+        print 'Started worker %d (pid %d, %d threads).' % (self.index, self.process.pid, self.threads)
+
+    def get_worker_id(self):
+        return '%s-%d' % (hostname, self.process.pid)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            stop_time = time.time() + stop_timeout_seconds
+            while self.process.poll() is None and time.time() < stop_time:
+                time.sleep(0.5)
+            if self.process.poll() is None:
+                # Hanging on shutdown: Kill it and release the claims it could not release itself
+                print 'Worker %d did not stop. Killing it.' % self.index
+                self.process.kill()
+                self.process.wait()
+                db.release_sample_claims(self.get_worker_id())
+        self.process = None
+
+    def check_limits(self):
+        # Watchdog: Kill the worker if it is stuck on a sample or uses too much memory. The samples it had started count
+        # as a failed attempt, so samples that keep killing workers are quarantined.
+        if self.process is None or self.process.poll() is not None:
+            return
+        reason = None
+        rss_mb = get_process_rss_mb(self.process.pid)
+        if config.worker_max_rss_mb and rss_mb is not None and rss_mb > config.worker_max_rss_mb:
+            reason = 'uses %d MB of memory' % rss_mb
+        elif config.worker_max_sample_seconds:
+            sample = db.get_overdue_sample_claim(self.get_worker_id(), config.worker_max_sample_seconds)
+            if sample is not None:
+                reason = 'is stuck on %s' % sample['filename']
+        if reason is not None:
+            print 'Worker %d %s. Killing it.' % (self.index, reason)
+            self.process.kill()
+            self.process.wait()
+
+    def check(self):
+        # Restart exited worker: Immediately if it requested it, otherwise after a growing delay
+        if self.process is None:
+            if time.time() >= self.restart_time:
+                self.start()
+            return
+        rval = self.process.poll()
+        if rval is None:
+            return
+        run_seconds = time.time() - self.start_time
+        if rval not in (0, EXITCODE_RESTART):
+            # Crashed or killed: Hand its samples to other workers right away
+            db.release_sample_claims(self.get_worker_id(), failed=True)
+        self.process = None
+        if rval == EXITCODE_RESTART:
+            self.failures = 0
+            self.start()
+            return
+        if run_seconds >= healthy_run_seconds:
+            self.failures = 0
+        self.failures += 1
+        backoff = min(2 ** (self.failures - 1), max_restart_backoff_seconds)
+        print 'Worker %d exited with code %s. Restarting in %ds.' % (self.index, str(rval), backoff)
+        self.restart_time = time.time() + backoff
+
+
+def get_target_worker_count(min_workers, max_workers):
+    pending = db.get_unprocessed_sample_count()
+    return max(min_workers, min(max_workers, -(-pending // samples_per_worker)))
+
+
+def run_supervisor(min_workers, max_workers, threads):
+    slots = []
+    last_busy_time = time.time()
+    listener = db.EventListener([db.event_samples])
+    try:
+        while True:
+            target_count = get_target_worker_count(min_workers, max_workers)
+            if target_count >= len(slots):
+                last_busy_time = time.time()
+            while len(slots) < target_count:
+                slots.append(WorkerSlot(len(slots), threads))
+            if len(slots) > target_count and time.time() - last_busy_time > scale_down_delay_seconds:
+                # Terminated workers release their claims, so their samples are taken over by the others
+                slots.pop().stop()
+                last_busy_time = time.time()
+            for slot in slots:
+                slot.check_limits()
+                slot.check()
+            db.set_status('supervisor', '%d workers running (%d threads each).'
+                          % (sum(1 for s in slots if s.process is not None), threads))
+            listener.wait(db.event_poll_seconds)
+    finally:
+        for slot in slots:
+            slot.stop()
+        db.set_status('supervisor', 'offline')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a pool of apply workers scaled with the processing backlog.')
+    parser.add_argument('--min-workers', type=int, default=1, help='Number of workers kept running when idle.')
+    parser.add_argument('--max-workers', type=int, default=0, help='Maximum number of workers (0: one per core).')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='CPU threads per worker (0: cores divided by maximum number of workers).')
+    add_config_option(parser)
+    args = parser.parse_args()
+    max_workers = args.max_workers or cpu_count()
+    min_workers = min(args.min_workers, max_workers)
+    threads = args.threads or max(1, cpu_count() // max_workers)
+    # Stop children on termination
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    run_supervisor(min_workers, max_workers, threads)